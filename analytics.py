@@ -0,0 +1,125 @@
+"""Vectorized usage statistics over arrays of readings.
+
+The readings come in as two contiguous arrays pulled with one query:
+`timestamps` (naive UTC, numpy datetime64[us]) and `levels` (percent),
+sorted by time. Consumption and refills are measured between consecutive
+readings of the same local day, which is what /update does one reading at a
+time. A drop in level is consumption, and a rise larger than
+`refill_threshold` percentage points is a refill. Smaller rises are sensor
+noise.
+
+Buckets are given by their edges (the UTC start of each local hour or day
+plus the end of the last one). Readings are assigned to buckets with
+searchsorted, and every per-bucket figure is a reduceat over the
+contiguous run of readings in that bucket.
+"""
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pytz
+
+NO_TIMESTAMP = np.datetime64('NaT', 'us')
+
+
+def to_datetime64(values):
+    """Parse naive UTC timestamps ('YYYY-MM-DD HH:MM:SS[.ffffff]' or datetime) without losing microseconds"""
+    return np.array(values, dtype='datetime64[us]')
+
+
+def from_epoch_seconds(values):
+    """Epoch seconds to datetime64[us]"""
+    return np.asarray(values, dtype='int64').astype('datetime64[s]').astype('datetime64[us]')
+
+
+def day_edges(first, last, tz):
+    """UTC starts of the local days from `first` to `last`, plus the end of the last day"""
+    first = pytz.UTC.localize(first.astype(datetime)).astimezone(tz).date()
+    last = pytz.UTC.localize(last.astype(datetime)).astimezone(tz).date()
+    edges = []
+    for offset in range((last - first).days + 2):
+        local_midnight = tz.localize(datetime.combine(first + timedelta(days=offset), time()))
+        edges.append(local_midnight.astimezone(pytz.UTC).replace(tzinfo=None))
+    return to_datetime64(edges)
+
+
+def hour_edges(days):
+    """Split day edges into hour edges"""
+    hours = [np.arange(start, end, np.timedelta64(1, 'h')) for start, end in zip(days[:-1], days[1:])]
+    return np.concatenate(hours + [days[-1:]])
+
+
+def assign_buckets(timestamps, edges):
+    """Index of the bucket holding each timestamp"""
+    return np.searchsorted(edges, timestamps, side='right') - 1
+
+
+def level_changes(levels, day_ids, refill_threshold=1.0):
+    """Per-reading consumption (cm of level dropped) and refill mask.
+
+    Both are measured against the previous reading, and are zero / False for
+    the first reading of each day.
+    """
+    previous = np.concatenate(([np.nan], levels[:-1]))
+    same_day = np.concatenate(([False], day_ids[1:] == day_ids[:-1]))
+    drops = np.where(same_day, np.clip(previous - levels, 0, None), 0.0)
+    refills = same_day & (levels > previous + refill_threshold)
+    return drops, refills
+
+
+def summarize(timestamps, levels, bucket_ids, drops, refills):
+    """Reduce sorted readings to one row per bucket.
+
+    Returns a dict of equal-length arrays: `bucket` (index into the edges),
+    `reading_count`, `level_sum`, `min_level`, `max_level`, `consumption`
+    (sum of `drops`), `last_level`, `last_reading_at` and `last_refill_at`
+    (NaT when the bucket saw no refill).
+    """
+    if len(levels) == 0:
+        empty = np.array([], dtype=float)
+        return {
+            'bucket': np.array([], dtype=int), 'reading_count': np.array([], dtype=int),
+            'level_sum': empty, 'min_level': empty, 'max_level': empty, 'consumption': empty,
+            'last_level': empty, 'last_reading_at': np.array([], dtype='datetime64[us]'),
+            'last_refill_at': np.array([], dtype='datetime64[us]'),
+        }
+
+    starts = np.flatnonzero(np.concatenate(([True], bucket_ids[1:] != bucket_ids[:-1])))
+    ends = np.concatenate((starts[1:], [len(levels)]))
+    refill_times = np.where(refills, timestamps, NO_TIMESTAMP).astype('int64')  # NaT is the smallest int64
+
+    return {
+        'bucket': bucket_ids[starts],
+        'reading_count': ends - starts,
+        'level_sum': np.add.reduceat(levels, starts),
+        'min_level': np.minimum.reduceat(levels, starts),
+        'max_level': np.maximum.reduceat(levels, starts),
+        'consumption': np.add.reduceat(drops, starts),
+        'last_level': levels[ends - 1],
+        'last_reading_at': timestamps[ends - 1],
+        'last_refill_at': np.maximum.reduceat(refill_times, starts).astype('datetime64[us]'),
+    }
+
+
+def usage_by_period(timestamps, levels, tz, liters_per_cm, refill_threshold=1.0):
+    """Hour and day summaries of the readings, as {'hour': ..., 'day': ...}.
+
+    Each summary also carries `bucket_start`, the UTC start of its bucket,
+    and its consumption is converted to litres.
+    """
+    if len(levels) == 0:
+        empty = summarize(timestamps, levels, np.array([], dtype=int), levels, levels)
+        empty['bucket_start'] = np.array([], dtype='datetime64[us]')
+        return {'hour': empty, 'day': dict(empty)}
+
+    days = day_edges(timestamps[0], timestamps[-1], tz)
+    hours = hour_edges(days)
+    day_ids = assign_buckets(timestamps, days)
+    drops, refills = level_changes(levels, day_ids, refill_threshold)
+    drops = drops * liters_per_cm
+
+    summaries = {}
+    for period, edges, bucket_ids in (('hour', hours, assign_buckets(timestamps, hours)), ('day', days, day_ids)):
+        summary = summarize(timestamps, levels, bucket_ids, drops, refills)
+        summary['bucket_start'] = edges[summary['bucket']]
+        summaries[period] = summary
+    return summaries
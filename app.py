@@ -1,25 +1,55 @@
-from flask import Flask, jsonify, request, render_template, send_from_directory
+from flask import Flask, Response, jsonify, request, render_template, send_from_directory, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, timedelta
 import os
 import pytz
 import logging
 import math
 import json
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from flask_cors import CORS  # Add this import
 from dotenv import load_dotenv
 import requests
 from werkzeug.utils import secure_filename
+from weather_cache import WeatherCache
+from config_store import ConfigStore
+from event_stream import EventBroadcaster
+import metrics
+import analytics
+import numpy as np
 import hashlib  # Add this import
+import calendar
+import sqlite3
+import csv
+import io
+import zlib
+from array import array
+import sys
+import threading
+import queue
+import time
+import atexit
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from types import SimpleNamespace
 
 # Constants
 TANK_HEIGHT = 100  # cm - maximum distance
+# Default tank geometry, given to devices registered without their own
 MIN_DISTANCE = 9   # cm - minimum distance from sensor to water
 MAX_DISTANCE = 100  # cm - maximum valid distance reading
 LITERS_PER_CM = 16  # Liters per cm of height
 USER_LOGIN = 'Ashiboy04'
 INITIAL_DATE = datetime(2025, 1, 25, 5, 37, 33, tzinfo=pytz.UTC)
+RECENT_READINGS_SIZE = 512  # Readings kept in memory for /api/latest
+EXPORT_CHUNK_ROWS = 1000  # Rows fetched and encoded per /api/export chunk
+MAX_BATCH_SIZE = 1000  # Samples accepted per /update/batch request
+
+# Load environment variables
+load_dotenv()
 
 # Create data and log directories if they don't exist
 os.makedirs('data', exist_ok=True)
@@ -28,22 +58,87 @@ os.makedirs('data', exist_ok=True)
 LOG_DIR = os.path.join(os.path.expanduser('~'), 'water_monitoring', 'logs')
 os.makedirs(LOG_DIR, exist_ok=True)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s UTC - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
-        RotatingFileHandler(
-            os.path.join(LOG_DIR, 'water_monitor.log'),
-            maxBytes=10485760,  # 10MB
-            backupCount=5
-        ),
-        logging.StreamHandler()
-    ]
-)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' or 'json'
+LOG_HOT_PATH_RATE = float(os.getenv('LOG_HOT_PATH_RATE', '1'))  # records/second from request hot paths
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+STANDARD_LOG_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, including fields passed via `extra`"""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update({
+            key: value for key, value in vars(record).items()
+            if key not in STANDARD_LOG_ATTRS
+        })
+        return json.dumps(entry, default=str)
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket allowing `rate` records per second through a logger.
+
+    Records at `always_level` or above always pass. The next record let
+    through carries a `suppressed` count of the records dropped before it.
+    """
+    def __init__(self, rate, burst=None, always_level=logging.ERROR):
+        super().__init__()
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self.always_level = always_level
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.always_level:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            if self.suppressed:
+                record.suppressed = self.suppressed
+                self.suppressed = 0
+        return True
+
+# Configure logging: requests only enqueue records, a listener thread does the I/O
+log_handlers = [
+    RotatingFileHandler(
+        os.path.join(LOG_DIR, 'water_monitor.log'),
+        maxBytes=10485760,  # 10MB
+        backupCount=5
+    ),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(
+        JsonFormatter() if LOG_FORMAT == 'json'
+        else logging.Formatter('%(asctime)s UTC - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S')
+    )
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))  # Final formatting happens in the listener
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 logger = logging.getLogger(__name__)
 
+# Per-request lines from /api/data and /update, rate limited
+hot_path_logger = logging.getLogger(f'{__name__}.hot_path')
+hot_path_logger.addFilter(RateLimitFilter(LOG_HOT_PATH_RATE))
+
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS
@@ -52,34 +147,155 @@ CORS(app)  # Enable CORS
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,If-None-Match')
+    response.headers.add('Access-Control-Expose-Headers', 'ETag,X-Count,X-Base-Timestamp,X-Columns,X-Next-Since-Id')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE')
     return response
 
+@app.before_request
+def start_request_metrics():
+    request.environ['metrics.started'] = time.perf_counter()
+    request.environ['metrics.endpoint'] = request.endpoint or 'unmatched'
+    metrics.REQUESTS_IN_PROGRESS.labels(request.environ['metrics.endpoint']).inc()
+
+@app.after_request
+def observe_request_metrics(response):
+    endpoint = request.environ.get('metrics.endpoint', 'unmatched')
+    metrics.REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(
+        time.perf_counter() - request.environ['metrics.started']
+    )
+    if not response.is_streamed and response.content_length is not None:
+        metrics.RESPONSE_SIZE.labels(endpoint).observe(response.content_length)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    endpoint = request.environ.pop('metrics.endpoint', None)
+    if endpoint:
+        metrics.REQUESTS_IN_PROGRESS.labels(endpoint).dec()
+
 # Database Configuration
 db_path = os.path.join(os.getcwd(), 'data', 'water_levels.db')
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))  # ms
+MIGRATION_LOCK_TIMEOUT = int(os.getenv('MIGRATION_LOCK_TIMEOUT', '600000'))  # ms a starting worker waits for another one's migration
+MIGRATION_BATCH_ROWS = int(os.getenv('MIGRATION_BATCH_ROWS', '20000'))  # rows converted per transaction
+SQLITE_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',  # Only takes effect on new databases, lets retention hand pages back
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),  # Readers don't block the writer
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),  # Safe with WAL, fsync only at checkpoints
+    'busy_timeout': SQLITE_BUSY_TIMEOUT,
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),  # bytes
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-65536')),  # negative = KiB
+    'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+}
 app.config.update(
     SECRET_KEY='dev-key-please-change-in-production',
     SQLALCHEMY_DATABASE_URI=f'sqlite:///{db_path}',
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
-    SQLALCHEMY_ECHO=True
+    SQLALCHEMY_ECHO=os.getenv('SQLALCHEMY_ECHO', '0') == '1',
+    SQLALCHEMY_ENGINE_OPTIONS={
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+        'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT / 1000},
+    }
 )
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply SQLITE_PRAGMAS to every new SQLite connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def observe_query_time(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        metrics.DB_QUERY_LATENCY.labels(metrics.statement_type(statement)).observe(
+            time.perf_counter() - context.query_started
+        )
+
 # Initialize SQLAlchemy
 db = SQLAlchemy(app)
 
-# Load environment variables
-load_dotenv()
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
 LOCATION_NAME = os.getenv('LOCATION_NAME', 'Chikitigarh')
 LOCATION_LAT = float(os.getenv('LOCATION_LAT', '20.2983'))
 LOCATION_LON = float(os.getenv('LOCATION_LON', '86.7215'))
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
-WEATHER_API_URL = "https://api.openweathermap.org/data/2.5/weather"
+WEATHER_API_URL = os.getenv('WEATHER_API_URL', "https://api.openweathermap.org/data/2.5/weather")
+WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', '600'))  # seconds before a background refresh
+WEATHER_CACHE_MAX_STALE = int(os.getenv('WEATHER_CACHE_MAX_STALE', '3600'))  # seconds stale data may still be served
+
+# Ingest mode: 'direct' commits every /update, 'queued' hands samples to a
+# background writer that group-commits them
+INGEST_MODE = os.getenv('INGEST_MODE', 'direct')
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '10000'))
+INGEST_FLUSH_INTERVAL = float(os.getenv('INGEST_FLUSH_INTERVAL', '0.2'))  # seconds
+INGEST_FLUSH_ROWS = int(os.getenv('INGEST_FLUSH_ROWS', '500'))
+# Batched samples may be at most this much older than the device's newest
+# reading. Older ones are rejected, as they would arrive behind the id and
+# time cursors of clients that already hold newer data.
+BATCH_MAX_BACKDATE = int(os.getenv('BATCH_MAX_BACKDATE', '3600'))  # seconds
+
+# Tank that readings and queries without a device refer to
+DEFAULT_DEVICE_ID = os.getenv('DEFAULT_DEVICE_ID', 'tank-1')
+DEVICE_CACHE_TTL = float(os.getenv('DEVICE_CACHE_TTL', '30'))  # seconds a worker trusts its copy of a device's geometry
+
+# A rise of more than this many percentage points between two readings counts
+# as a refill, smaller ones are sensor noise
+REFILL_THRESHOLD = float(os.getenv('REFILL_THRESHOLD', '1'))
+
+# Usage/refill event detection, run on every reading (see detect_events)
+EVENT_HYSTERESIS = float(os.getenv('EVENT_HYSTERESIS', '1'))  # percentage points
+EVENT_MIN_DURATION = int(os.getenv('EVENT_MIN_DURATION', '120'))  # seconds, shorter events are dropped as glitches
+EVENT_IDLE_TIMEOUT = int(os.getenv('EVENT_IDLE_TIMEOUT', '1800'))  # seconds without a new low/high that end an event
+MAX_EVENTS_LIMIT = 1000  # Events returned per /api/events request
+
+# Retention: raw readings older than RETENTION_RAW_DAYS are compacted into
+# 1-minute aggregates, those older than RETENTION_MINUTE_DAYS into IST-day
+# aggregates, which are kept forever. 0 keeps a tier forever.
+RETENTION_RAW_DAYS = int(os.getenv('RETENTION_RAW_DAYS', '30'))
+RETENTION_MINUTE_DAYS = int(os.getenv('RETENTION_MINUTE_DAYS', '365'))
+RETENTION_BATCH_ROWS = int(os.getenv('RETENTION_BATCH_ROWS', '5000'))  # rows moved per transaction
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', '0'))  # seconds between background runs, off (0) unless set
+RETENTION_VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', '2000'))  # free pages released per run
+
+# Live stream (/api/stream). Every open stream holds a worker thread, so run
+# gunicorn with --threads.
+SSE_HEARTBEAT = int(os.getenv('SSE_HEARTBEAT', '15'))  # seconds between keep-alive comments
+SSE_POLL_INTERVAL = float(os.getenv('SSE_POLL_INTERVAL', '0.25'))  # seconds between checks for other workers' readings
+SSE_MAX_CLIENTS = int(os.getenv('SSE_MAX_CLIENTS', '50'))  # open streams per worker
+
+# Shared by every dashboard (and, through the cache file, every worker)
+weather_cache = WeatherCache(
+    WEATHER_API_URL,
+    {
+        'lat': LOCATION_LAT,
+        'lon': LOCATION_LON,
+        'appid': OPENWEATHER_API_KEY,
+        'units': 'metric'  # For Celsius
+    },
+    ttl=WEATHER_CACHE_TTL,
+    on_count=lambda key: metrics.WEATHER_CACHE_EVENTS.labels(key).inc(),
+    on_fetch=metrics.WEATHER_UPSTREAM_LATENCY.observe,
+    max_stale=WEATHER_CACHE_MAX_STALE,
+    cache_file=os.path.join(os.getcwd(), 'data', 'weather_cache.json')
+)
 
 # Configuration file path
 CONFIG_FILE_PATH = os.path.join(os.getcwd(), 'data', 'config.json')
 FIRMWARE_DIR = os.path.join(os.getcwd(), 'data', 'firmware')
+FIRMWARE_PATH = os.path.join(FIRMWARE_DIR, 'firmware.bin')
+FIRMWARE_MANIFEST_PATH = os.path.join(FIRMWARE_DIR, 'manifest.json')
 os.makedirs(FIRMWARE_DIR, exist_ok=True)
 
 # Load default configuration
@@ -90,39 +306,186 @@ default_config = {
     "version": "1.0.0"
 }
 
-# Ensure config file exists
-if not os.path.exists(CONFIG_FILE_PATH):
-    with open(CONFIG_FILE_PATH, 'w') as f:
-        json.dump(default_config, f)
+# Cached config, created with the defaults if the file doesn't exist
+config_store = ConfigStore(CONFIG_FILE_PATH, default_config)
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+IST_OFFSET = timedelta(hours=5, minutes=30)  # India has no DST, so IST is a fixed offset
+
+class EpochSeconds(db.TypeDecorator):
+    """Naive UTC datetime stored as integer epoch seconds.
+
+    Python code keeps using datetimes. The table holds a small integer, so
+    there is no string parsing on read and the timestamp index stays compact.
+    """
+    impl = db.Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, datetime):
+            return calendar.timegm(value.utctimetuple())  # Naive values are taken as UTC
+        return value
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else UNIX_EPOCH + timedelta(seconds=value)
 
 # Models
+class Device(db.Model):
+    __tablename__ = 'devices'
+
+    id = db.Column(db.String(50), primary_key=True)
+    name = db.Column(db.String(100))
+    min_distance = db.Column(db.Float, nullable=False, default=MIN_DISTANCE)
+    max_distance = db.Column(db.Float, nullable=False, default=MAX_DISTANCE)
+    liters_per_cm = db.Column(db.Float, nullable=False, default=LITERS_PER_CM)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'device_id': self.id,
+            'name': self.name,
+            'min_distance': self.min_distance,
+            'max_distance': self.max_distance,
+            'liters_per_cm': self.liters_per_cm
+        }
+
 class WaterLevel(db.Model):
     __tablename__ = 'water_levels'
     
-    # Add index for timestamp
+    # Covering index: per-tank range scans over time read level and id from the index alone
     __table_args__ = (
-        db.Index('idx_timestamp', 'timestamp'),
+        db.Index('idx_device_timestamp', 'device_id', 'timestamp', 'water_level', 'id'),
     )
     
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    device_id = db.Column(db.String(50), nullable=False, default=DEFAULT_DEVICE_ID, server_default=DEFAULT_DEVICE_ID)
+    timestamp = db.Column(EpochSeconds, nullable=False, default=datetime.utcnow)
     distance = db.Column(db.Float, nullable=False)
     water_level = db.Column(db.Float, nullable=False)
     water_volume = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), nullable=False, default='valid')
 
     def to_dict(self):
-        # Convert UTC to IST for display
-        ist_time = self.timestamp.replace(tzinfo=pytz.UTC).astimezone(pytz.timezone('Asia/Kolkata'))
         return {
             'id': self.id,
-            'timestamp': ist_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'device_id': self.device_id,
+            'timestamp': format_ist(self.timestamp),
             'distance': round(self.distance, 2),
             'water_level': round(self.water_level, 2),
             'water_volume': round(self.water_volume, 2),
             'status': self.status
         }
 
+class UsageRollup(db.Model):
+    __tablename__ = 'usage_rollups'
+
+    # One row per tank and IST hour / IST day
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'period', 'bucket_start', name='uq_rollup_bucket'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(50), nullable=False, default=DEFAULT_DEVICE_ID)
+    period = db.Column(db.String(10), nullable=False)  # 'hour' or 'day'
+    bucket_start = db.Column(db.DateTime, nullable=False)  # UTC start of the IST period
+    reading_count = db.Column(db.Integer, nullable=False, default=0)
+    level_sum = db.Column(db.Float, nullable=False, default=0)
+    min_level = db.Column(db.Float)
+    max_level = db.Column(db.Float)
+    consumption = db.Column(db.Float, nullable=False, default=0)  # Liters
+    last_level = db.Column(db.Float)
+    last_reading_at = db.Column(db.DateTime)
+    last_refill_at = db.Column(db.DateTime)
+
+    @property
+    def avg_level(self):
+        return self.level_sum / self.reading_count if self.reading_count else 0
+
+    def to_dict(self):
+        ist = pytz.timezone('Asia/Kolkata')
+        return {
+            'period': self.period,
+            'start': self.bucket_start.replace(tzinfo=pytz.UTC).astimezone(ist).strftime('%Y-%m-%d %H:%M:%S'),
+            'readings_count': self.reading_count,
+            'avg_level': round(self.avg_level, 2),
+            'min_level': round(self.min_level, 2),
+            'max_level': round(self.max_level, 2),
+            'consumption': round(self.consumption, 2)
+        }
+
+class ReadingAggregate(db.Model):
+    __tablename__ = 'reading_aggregates'
+
+    # Compacted readings, one row per tank and minute / IST day
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'period', 'bucket_start', name='uq_aggregate_bucket'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(50), nullable=False, default=DEFAULT_DEVICE_ID)
+    period = db.Column(db.String(10), nullable=False)  # 'minute' or 'day'
+    bucket_start = db.Column(EpochSeconds, nullable=False)  # UTC start of the minute / IST day
+    reading_count = db.Column(db.Integer, nullable=False)
+    distance_sum = db.Column(db.Float, nullable=False)
+    level_sum = db.Column(db.Float, nullable=False)
+    volume_sum = db.Column(db.Float, nullable=False)
+    min_level = db.Column(db.Float, nullable=False)
+    max_level = db.Column(db.Float, nullable=False)
+
+class TankEvent(db.Model):
+    __tablename__ = 'events'
+
+    # A device's history of one kind is a single index range, newest first
+    __table_args__ = (
+        db.Index('idx_event_device_kind_start', 'device_id', 'kind', 'started_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(50), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # 'usage' or 'refill'
+    started_at = db.Column(EpochSeconds, nullable=False)
+    ended_at = db.Column(EpochSeconds, nullable=False)
+    start_level = db.Column(db.Float, nullable=False)
+    end_level = db.Column(db.Float, nullable=False)
+    liters = db.Column(db.Float, nullable=False)
+    duration = db.Column(db.Integer, nullable=False)  # seconds
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'kind': self.kind,
+            'started_at': format_ist(self.started_at),
+            'ended_at': format_ist(self.ended_at),
+            'start_level': round(self.start_level, 2),
+            'end_level': round(self.end_level, 2),
+            'liters': round(self.liters, 2),
+            'duration': self.duration
+        }
+
+class EventDetectorState(db.Model):
+    __tablename__ = 'event_detector_state'
+
+    # Where each device's event detector stopped, updated with every reading
+    device_id = db.Column(db.String(50), primary_key=True)
+    mode = db.Column(db.String(10), nullable=False, default='idle')  # 'idle', 'usage' or 'refill'
+    start_at = db.Column(EpochSeconds)  # Start of the open event
+    start_level = db.Column(db.Float)
+    extreme_at = db.Column(EpochSeconds)  # Lowest (usage) / highest (refill) point so far
+    extreme_level = db.Column(db.Float)  # While idle, the level the next event is measured from
+    last_reading_at = db.Column(EpochSeconds)
+
+    def to_dict(self):
+        if self.mode == 'idle':
+            return None
+        return {
+            'kind': self.mode,
+            'started_at': format_ist(self.start_at),
+            'start_level': round(self.start_level, 2),
+            'level': round(self.extreme_level, 2),
+            'updated_at': format_ist(self.extreme_at)
+        }
+
 class Settings(db.Model):
     __tablename__ = 'settings'
     
@@ -146,6 +509,730 @@ class Settings(db.Model):
             'last_update': self.last_update.strftime('%Y-%m-%d %H:%M:%S')
         }
 
+# Geometry of registered devices, cached per worker
+DeviceGeometry = namedtuple('DeviceGeometry', 'id min_distance max_distance liters_per_cm')
+device_cache = {}
+
+def get_device(device_id):
+    """Geometry of a registered device, or None if there is no such device"""
+    now = time.monotonic()
+    cached = device_cache.get(device_id)
+    if cached and now - cached[1] < DEVICE_CACHE_TTL:
+        return cached[0]
+    device = db.session.get(Device, device_id)
+    if device is None:
+        return None  # Not cached, so a device registered by another worker is found at once
+    geometry = DeviceGeometry(device.id, device.min_distance, device.max_distance, device.liters_per_cm)
+    device_cache[device_id] = (geometry, now)
+    return geometry
+
+def device_ids():
+    return db.session.scalars(db.select(Device.id).order_by(Device.id)).all()
+
+def request_device(data=None):
+    """(device id, geometry) named by `device_id` in `data` or `device` in the query string, the default tank otherwise"""
+    device_id = (data.get('device_id') if data else None) or request.args.get('device') or DEFAULT_DEVICE_ID
+    return str(device_id), get_device(str(device_id))
+
+def unknown_device(device_id):
+    return jsonify({'error': f'Unknown device: {device_id}. Register it with POST /api/devices'}), 404
+
+# In-memory ring buffer of the most recent readings (serialized form), in id order
+recent_readings = deque(maxlen=RECENT_READINGS_SIZE)
+recent_readings_lock = threading.Lock()
+# Every reading up to this id has been pulled from the database. Readings
+# commit in id order (SQLite has one writer), so ids above it may still be
+# missing readings that other workers or threads committed.
+recent_synced_id = 0
+
+def insert_recent_reading(reading):
+    """Put a reading into the ring buffer at its place by id (lock held)"""
+    index = len(recent_readings)
+    while index and recent_readings[index - 1]['id'] >= reading['id']:
+        if recent_readings[index - 1]['id'] == reading['id']:
+            return
+        index -= 1
+    if len(recent_readings) == recent_readings.maxlen:
+        if index == 0:
+            return  # Older than everything held
+        recent_readings.popleft()
+        index -= 1
+    recent_readings.insert(index, reading)
+
+def push_recent_reading(reading):
+    """Add a freshly committed reading to the ring buffer"""
+    with recent_readings_lock:
+        insert_recent_reading(reading)
+
+def sync_recent_readings():
+    """Pull readings written by other workers into the ring buffer.
+
+    MAX(id) on the primary key is a single index lookup, so this stays O(1)
+    unless there really are new rows to fetch.
+    """
+    global recent_synced_id
+    with recent_readings_lock:
+        synced_id = recent_synced_id
+
+    max_id = db.session.query(db.func.max(WaterLevel.id)).scalar() or 0
+    if max_id < synced_id:
+        # Table was erased, start over
+        with recent_readings_lock:
+            recent_readings.clear()
+            recent_synced_id = synced_id = 0
+    if max_id == synced_id:
+        return
+
+    readings = WaterLevel.query.filter(
+        WaterLevel.id > synced_id
+    ).order_by(WaterLevel.id.desc()).limit(RECENT_READINGS_SIZE).all()
+
+    with recent_readings_lock:
+        for reading in reversed(readings):
+            insert_recent_reading(reading.to_dict())
+        if readings:
+            recent_synced_id = max(recent_synced_id, readings[0].id)
+
+# Id of the last reading pushed to /api/stream clients by this worker
+last_streamed_id = 0
+stream_publish_lock = threading.Lock()  # Keeps readings in id order across publishing threads
+
+def publish_new_readings():
+    """Stream the readings committed since the last call, followed by today's counters.
+
+    Readings are taken up to the synced id only, so one that another worker
+    committed just before this worker's own is never skipped.
+    """
+    global last_streamed_id
+    sync_recent_readings()
+    with stream_publish_lock:
+        with recent_readings_lock:
+            if recent_synced_id < last_streamed_id:
+                last_streamed_id = 0  # Table was erased, ids start over
+            new_readings = [r for r in recent_readings if last_streamed_id < r['id'] <= recent_synced_id]
+            if new_readings:
+                last_streamed_id = new_readings[-1]['id']
+
+        if not new_readings or not event_broadcaster.subscriber_count():
+            return
+        for reading in new_readings:
+            event_broadcaster.publish('reading', reading['id'], reading)
+    for device_id in dict.fromkeys(r['device_id'] for r in new_readings):
+        event_broadcaster.publish('stats', new_readings[-1]['id'], daily_stats_payload(device_id=device_id))
+
+def stream_new_readings():
+    """Called after this worker commits readings"""
+    publish_new_readings()
+    event_broadcaster.notify()
+
+def pull_stream_events():
+    """Called when another worker has committed readings"""
+    with app.app_context():
+        sync_recent_readings()
+        publish_new_readings()
+
+event_broadcaster = EventBroadcaster(
+    os.path.join(os.getcwd(), 'data', 'stream.notify'),
+    on_change=pull_stream_events,
+    poll_interval=SSE_POLL_INTERVAL
+)
+app.extensions['event_broadcaster'] = event_broadcaster  # gunicorn.conf.py closes the streams on SIGTERM
+atexit.register(event_broadcaster.close)
+
+def ist_bucket_starts(timestamp):
+    """Return the UTC starts of the IST hour and IST day containing `timestamp`"""
+    ist_time = timestamp.replace(tzinfo=pytz.UTC).astimezone(pytz.timezone('Asia/Kolkata'))
+    hour_start = ist_time.replace(minute=0, second=0, microsecond=0)
+    day_start = hour_start.replace(hour=0)
+    return (
+        hour_start.astimezone(pytz.UTC).replace(tzinfo=None),
+        day_start.astimezone(pytz.UTC).replace(tzinfo=None)
+    )
+
+def get_or_create_rollup(device_id, period, bucket_start):
+    rollup = UsageRollup.query.filter_by(device_id=device_id, period=period, bucket_start=bucket_start).first()
+    if not rollup:
+        rollup = UsageRollup(
+            device_id=device_id, period=period, bucket_start=bucket_start,
+            reading_count=0, level_sum=0, consumption=0
+        )
+        db.session.add(rollup)
+    return rollup
+
+def apply_reading_to_rollups(device, timestamp, water_level, get_rollup=get_or_create_rollup):
+    """Fold one reading of `device` into its hour and day rollups.
+
+    Consumption and refills are measured against the previous reading of the
+    same IST day, like the stats endpoints always did. Call this after the
+    reading has been flushed so the write lock is already held and no other
+    worker can interleave between reading and updating the rollup rows.
+    """
+    timestamp = timestamp.astimezone(pytz.UTC).replace(tzinfo=None) if timestamp.tzinfo else timestamp
+    hour_start, day_start = ist_bucket_starts(timestamp)
+    day = get_rollup(device.id, 'day', day_start)
+    hour = get_rollup(device.id, 'hour', hour_start)
+
+    consumption = 0
+    refilled = False
+    if day.last_reading_at is not None and timestamp >= day.last_reading_at:
+        if water_level < day.last_level:
+            consumption = (day.last_level - water_level) * device.liters_per_cm
+        elif water_level > day.last_level + REFILL_THRESHOLD:
+            refilled = True
+
+    for rollup in (day, hour):
+        rollup.reading_count += 1
+        rollup.level_sum += water_level
+        rollup.min_level = water_level if rollup.min_level is None else min(rollup.min_level, water_level)
+        rollup.max_level = water_level if rollup.max_level is None else max(rollup.max_level, water_level)
+        rollup.consumption += consumption
+        if refilled:
+            rollup.last_refill_at = timestamp
+        if rollup.last_reading_at is None or timestamp >= rollup.last_reading_at:
+            rollup.last_level = water_level
+            rollup.last_reading_at = timestamp
+
+def apply_readings_to_rollups(device, readings):
+    """Fold a device's readings (in time order) into its rollups with one query and one flush.
+
+    The hour and day rollups the readings can touch are loaded together,
+    updated in memory by apply_reading_to_rollups and written back by the
+    next flush, instead of a lookup and an autoflush per reading.
+    """
+    first = min(reading.timestamp for reading in readings)
+    last = max(reading.timestamp for reading in readings)
+    rollups = {
+        (rollup.period, rollup.bucket_start): rollup
+        for rollup in UsageRollup.query.filter(
+            UsageRollup.device_id == device.id,
+            UsageRollup.bucket_start >= ist_bucket_starts(first)[1],
+            UsageRollup.bucket_start <= last
+        )
+    }
+
+    def get_rollup(device_id, period, bucket_start):
+        rollup = rollups.get((period, bucket_start))
+        if rollup is None:
+            rollup = rollups[(period, bucket_start)] = get_or_create_rollup(device_id, period, bucket_start)
+        return rollup
+
+    with db.session.no_autoflush:
+        for reading in readings:
+            apply_reading_to_rollups(device, reading.timestamp, reading.water_level, get_rollup)
+
+def close_event(state, device):
+    """The finished event of `state`, or None if it is shorter than EVENT_MIN_DURATION"""
+    duration = int((state.extreme_at - state.start_at).total_seconds())
+    if duration < EVENT_MIN_DURATION:
+        return None
+    return {
+        'device_id': device.id,
+        'kind': state.mode,
+        'started_at': state.start_at,
+        'ended_at': state.extreme_at,
+        'start_level': state.start_level,
+        'end_level': state.extreme_level,
+        'liters': abs(state.start_level - state.extreme_level) * device.liters_per_cm,
+        'duration': duration
+    }
+
+def detect_events(state, device, timestamp, water_level):
+    """Advance a device's usage/refill state machine by one reading; return the events it finished.
+
+    An event starts once the level has moved EVENT_HYSTERESIS points away
+    from where it rested, and follows it to its lowest (usage) or highest
+    (refill) point. It ends there when the level turns back by
+    EVENT_HYSTERESIS, which starts the opposite event, or when no new
+    extreme comes for EVENT_IDLE_TIMEOUT seconds. Readings older than the
+    last one seen are skipped, the detector only moves forward.
+    """
+    timestamp = timestamp.astimezone(pytz.UTC).replace(tzinfo=None) if timestamp.tzinfo else timestamp
+    if state.last_reading_at is not None and timestamp < state.last_reading_at:
+        return []
+
+    finished = []
+    if state.extreme_level is None:
+        state.mode = 'idle'
+        state.extreme_at, state.extreme_level = timestamp, water_level
+    elif state.mode == 'idle':
+        change = water_level - state.extreme_level
+        if abs(change) >= EVENT_HYSTERESIS:
+            state.mode = 'usage' if change < 0 else 'refill'
+            state.start_at, state.start_level = state.last_reading_at, state.extreme_level
+            state.extreme_at, state.extreme_level = timestamp, water_level
+    else:
+        falling = state.mode == 'usage'
+        if water_level < state.extreme_level if falling else water_level > state.extreme_level:
+            state.extreme_at, state.extreme_level = timestamp, water_level
+        elif abs(water_level - state.extreme_level) >= EVENT_HYSTERESIS:
+            # Turned around: the opposite event starts where this one ended
+            finished.append(close_event(state, device))
+            state.mode = 'refill' if falling else 'usage'
+            state.start_at, state.start_level = state.extreme_at, state.extreme_level
+            state.extreme_at, state.extreme_level = timestamp, water_level
+        elif (timestamp - state.extreme_at).total_seconds() >= EVENT_IDLE_TIMEOUT:
+            finished.append(close_event(state, device))
+            state.mode = 'idle'
+
+    state.last_reading_at = timestamp
+    return [event for event in finished if event is not None]
+
+def apply_readings_to_events(device, readings):
+    """Run a device's readings (in time order) through its event detector and store the events they finish.
+
+    Like apply_reading_to_rollups, call this after the readings have been
+    flushed, so the state row is read and written under the write lock. The
+    state is loaded once and the finished events are inserted together.
+    """
+    state = db.session.get(EventDetectorState, device.id)
+    if state is None:
+        state = EventDetectorState(device_id=device.id, mode='idle')
+        db.session.add(state)
+    finished = []
+    with db.session.no_autoflush:
+        for reading in readings:
+            finished.extend(detect_events(state, device, reading.timestamp, reading.water_level))
+    if finished:
+        db.session.execute(db.insert(TankEvent), finished)
+
+@contextmanager
+def schema_lock():
+    """Connection holding the database write lock, for schema changes at startup.
+
+    Waits up to MIGRATION_LOCK_TIMEOUT for a process that is already
+    migrating, instead of failing after the usual SQLITE_BUSY_TIMEOUT.
+    """
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql(f'PRAGMA busy_timeout = {MIGRATION_LOCK_TIMEOUT}')
+        try:
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.exec_driver_sql('COMMIT')
+            except Exception:
+                conn.exec_driver_sql('ROLLBACK')
+                raise
+        finally:
+            conn.exec_driver_sql(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}')
+
+def migrate_timestamps_to_epoch():
+    """Convert readings stored with DATETIME text timestamps to epoch seconds.
+
+    Older databases keep the timestamp as 'YYYY-MM-DD HH:MM:SS[.ffffff]' text.
+    SQLite lets the column hold integers without a table rebuild, so the rows
+    are converted in place, MIGRATION_BATCH_ROWS ids per transaction so the
+    write lock is never held for long. Text rows predate devices and text
+    sorts after every number, so MAX() on the default device's index finds
+    any unconverted row and the check is cheap once done. Runs after
+    migrate_device_columns().
+    """
+    with db.engine.connect() as conn:
+        pending = conn.exec_driver_sql(
+            "SELECT typeof(MAX(timestamp)) = 'text' FROM water_levels WHERE device_id = ?",
+            (DEFAULT_DEVICE_ID,)
+        ).scalar()
+        first_id, last_id = conn.exec_driver_sql('SELECT MIN(id), MAX(id) FROM water_levels').first()
+    if pending:
+        converted = 0
+        for start in range(first_id - 1, last_id, MIGRATION_BATCH_ROWS):
+            with schema_lock() as conn:
+                converted += conn.exec_driver_sql(
+                    "UPDATE water_levels SET timestamp = CAST(strftime('%s', timestamp) AS INTEGER) "
+                    "WHERE id > ? AND id <= ? AND typeof(timestamp) = 'text'",
+                    (start, start + MIGRATION_BATCH_ROWS)
+                ).rowcount
+        logger.info(f"Converted {converted} reading timestamps to epoch seconds")
+    with schema_lock() as conn:
+        conn.exec_driver_sql('DROP INDEX IF EXISTS idx_timestamp')
+
+def migrate_device_columns():
+    """Give single-tank databases a device_id, assigning existing data to DEFAULT_DEVICE_ID.
+
+    water_levels gets the column with ALTER TABLE, which SQLite does without
+    rewriting rows, and its time index is swapped for the per-device one. The
+    rollup and aggregate tables need the device in their unique constraints,
+    so they are rebuilt and their rows copied over. The write lock is taken
+    before looking at the schema, so processes starting together migrate once.
+    """
+    with schema_lock() as conn:
+        def columns(table):
+            return [row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info({table})')]
+
+        if 'device_id' not in columns('water_levels'):
+            conn.exec_driver_sql(
+                f"ALTER TABLE water_levels ADD COLUMN device_id VARCHAR(50) NOT NULL DEFAULT '{DEFAULT_DEVICE_ID}'"
+            )
+            logger.info(f"Assigned existing readings to device {DEFAULT_DEVICE_ID}")
+        conn.exec_driver_sql(
+            'CREATE INDEX IF NOT EXISTS idx_device_timestamp ON water_levels (device_id, timestamp, water_level, id)'
+        )
+        conn.exec_driver_sql('DROP INDEX IF EXISTS idx_timestamp_level')
+
+        for model in (UsageRollup, ReadingAggregate):
+            table = model.__tablename__
+            existing = columns(table)
+            if 'device_id' in existing:
+                continue
+            conn.exec_driver_sql(f'ALTER TABLE {table} RENAME TO {table}_single')
+            model.__table__.create(conn)
+            column_list = ', '.join(existing)
+            conn.exec_driver_sql(
+                f'INSERT INTO {table} ({column_list}, device_id) SELECT {column_list}, ? FROM {table}_single',
+                (DEFAULT_DEVICE_ID,)
+            )
+            conn.exec_driver_sql(f'DROP TABLE {table}_single')
+            logger.info(f"Rebuilt {table} with a device_id column")
+
+def backfill_rollups():
+    """Rebuild usage_rollups from the raw readings of every device"""
+    readings = rollups = 0
+    for device_id in device_ids():
+        device_readings, device_rollups = backfill_device_rollups(get_device(device_id))
+        readings += device_readings
+        rollups += device_rollups
+    return readings, rollups
+
+def backfill_device_rollups(device):
+    """Rebuild one device's usage_rollups from its raw readings.
+
+    The readings are pulled in one query into NumPy arrays and summarized by
+    analytics.usage_by_period, which gives the same rollups as feeding them
+    through apply_reading_to_rollups one at a time.
+    """
+    # Rollups older than the first raw reading cover days retention has
+    # already compacted, so they can't be rebuilt and are kept
+    first = db.session.query(db.func.min(WaterLevel.timestamp)).filter(WaterLevel.device_id == device.id).scalar()
+    if first is None:
+        return 0, 0
+    UsageRollup.query.filter(
+        UsageRollup.device_id == device.id,
+        UsageRollup.bucket_start >= ist_bucket_starts(first)[1]
+    ).delete()
+
+    # Raw epoch seconds convert straight into datetime64
+    result = db.session.execute(
+        db.select(db.type_coerce(WaterLevel.timestamp, db.Integer), WaterLevel.water_level)
+        .where(WaterLevel.device_id == device.id)
+        .order_by(WaterLevel.timestamp.asc(), WaterLevel.id.asc())
+        .execution_options(yield_per=100000)
+    )
+    timestamps, levels = [], []
+    for partition in result.partitions():
+        chunk_timestamps, chunk_levels = zip(*partition)
+        timestamps.append(analytics.from_epoch_seconds(chunk_timestamps))
+        levels.append(np.array(chunk_levels, dtype=float))
+    timestamps = np.concatenate(timestamps)
+    levels = np.concatenate(levels)
+
+    summaries = analytics.usage_by_period(
+        timestamps, levels, pytz.timezone('Asia/Kolkata'), device.liters_per_cm, REFILL_THRESHOLD
+    )
+    rows = []
+    for period, summary in summaries.items():
+        for i in range(len(summary['bucket'])):
+            last_refill_at = summary['last_refill_at'][i]
+            rows.append({
+                'device_id': device.id,
+                'period': period,
+                'bucket_start': summary['bucket_start'][i].astype(datetime),
+                'reading_count': int(summary['reading_count'][i]),
+                'level_sum': float(summary['level_sum'][i]),
+                'min_level': float(summary['min_level'][i]),
+                'max_level': float(summary['max_level'][i]),
+                'consumption': float(summary['consumption'][i]),
+                'last_level': float(summary['last_level'][i]),
+                'last_reading_at': summary['last_reading_at'][i].astype(datetime),
+                'last_refill_at': None if np.isnat(last_refill_at) else last_refill_at.astype(datetime),
+            })
+
+    db.session.execute(db.insert(UsageRollup), rows)
+    db.session.commit()
+    return len(levels), len(rows)
+
+def backfill_events():
+    """Rebuild the usage/refill events of every device from the raw readings"""
+    readings = events = 0
+    for device_id in device_ids():
+        device_readings, device_events = backfill_device_events(get_device(device_id))
+        readings += device_readings
+        events += device_events
+    return readings, events
+
+def backfill_device_events(device):
+    """Replay one device's raw readings through a fresh event detector.
+
+    Events that started before the first raw reading can't be rebuilt, as
+    retention has compacted their readings, and are kept.
+    """
+    first = db.session.query(db.func.min(WaterLevel.timestamp)).filter(WaterLevel.device_id == device.id).scalar()
+    if first is None:
+        return 0, 0
+    TankEvent.query.filter(TankEvent.device_id == device.id, TankEvent.started_at >= first).delete()
+    EventDetectorState.query.filter_by(device_id=device.id).delete()
+
+    # A plain object while replaying, attribute writes on a mapped instance are slower
+    state = SimpleNamespace(
+        mode='idle', start_at=None, start_level=None, extreme_at=None, extreme_level=None, last_reading_at=None
+    )
+    result = db.session.execute(
+        db.select(db.type_coerce(WaterLevel.timestamp, db.Integer), WaterLevel.water_level)
+        .where(WaterLevel.device_id == device.id)
+        .order_by(WaterLevel.timestamp.asc(), WaterLevel.id.asc())
+        .execution_options(yield_per=100000)
+    )
+    count = 0
+    events = []
+    for partition in result.partitions():
+        for epoch, water_level in partition:
+            events.extend(detect_events(state, device, UNIX_EPOCH + timedelta(seconds=epoch), water_level))
+        count += len(partition)
+
+    if events:
+        db.session.execute(db.insert(TankEvent), events)
+    db.session.add(EventDetectorState(device_id=device.id, **vars(state)))
+    db.session.commit()
+    return count, len(events)
+
+IST_OFFSET_SECONDS = int(IST_OFFSET.total_seconds())
+AGGREGATE_COLUMNS = ('reading_count', 'distance_sum', 'level_sum', 'volume_sum', 'min_level', 'max_level')
+
+def bucket_of(period, epoch):
+    """Start (epoch seconds) of the minute / IST day holding `epoch`; works on ints and SQL expressions"""
+    if period == 'minute':
+        return epoch // 60 * 60
+    return (epoch + IST_OFFSET_SECONDS) // 86400 * 86400 - IST_OFFSET_SECONDS
+
+def retention_cutoff(days, now):
+    """Start of the IST day `days` days before `now`, or None to keep the tier forever.
+
+    Cutting at day boundaries keeps every IST day whole in one tier, so
+    backfill_rollups() can still rebuild the days it finds in the raw table.
+    """
+    if days <= 0:
+        return None
+    return ist_bucket_starts(now - timedelta(days=days))[1]
+
+def merge_aggregates(period, device_id, rows):
+    """Add rows of (epoch, *AGGREGATE_COLUMNS) into the device's `period` aggregates"""
+    buckets = {}
+    for epoch, count, distance_sum, level_sum, volume_sum, min_level, max_level in rows:
+        key = bucket_of(period, epoch)
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [count, distance_sum, level_sum, volume_sum, min_level, max_level]
+        else:
+            bucket[0] += count
+            bucket[1] += distance_sum
+            bucket[2] += level_sum
+            bucket[3] += volume_sum
+            bucket[4] = min(bucket[4], min_level)
+            bucket[5] = max(bucket[5], max_level)
+    if not buckets:
+        return
+
+    stmt = sqlite_insert(ReadingAggregate)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['device_id', 'period', 'bucket_start'],
+        set_={
+            'reading_count': ReadingAggregate.reading_count + stmt.excluded.reading_count,
+            'distance_sum': ReadingAggregate.distance_sum + stmt.excluded.distance_sum,
+            'level_sum': ReadingAggregate.level_sum + stmt.excluded.level_sum,
+            'volume_sum': ReadingAggregate.volume_sum + stmt.excluded.volume_sum,
+            'min_level': db.func.min(ReadingAggregate.min_level, stmt.excluded.min_level),
+            'max_level': db.func.max(ReadingAggregate.max_level, stmt.excluded.max_level),
+        }
+    )
+    db.session.execute(stmt, [
+        dict(zip(AGGREGATE_COLUMNS, values), device_id=device_id, period=period, bucket_start=key)
+        for key, values in buckets.items()
+    ])
+
+def compact_rows(delete_stmt, period, device_id):
+    """Move rows of one device into `period` aggregates, RETENTION_BATCH_ROWS per transaction.
+
+    `delete_stmt` deletes one batch and returns (epoch, *AGGREGATE_COLUMNS)
+    for each row. Deleting first makes every batch claim its rows under the
+    write lock, so concurrent runs in other workers never count a row twice.
+    """
+    moved = 0
+    while True:
+        try:
+            rows = db.session.execute(delete_stmt, execution_options={'synchronize_session': False}).all()
+            merge_aggregates(period, device_id, rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        moved += len(rows)
+        if len(rows) < RETENTION_BATCH_ROWS:
+            return moved
+
+def compact_raw_readings(device_id, cutoff):
+    """Compact a device's raw readings older than `cutoff` into minute aggregates"""
+    batch = db.select(WaterLevel.id).where(
+        WaterLevel.device_id == device_id,
+        WaterLevel.timestamp < cutoff
+    ).order_by(WaterLevel.timestamp.asc()).limit(RETENTION_BATCH_ROWS)
+    return compact_rows(
+        db.delete(WaterLevel).where(WaterLevel.id.in_(batch)).returning(
+            db.type_coerce(WaterLevel.timestamp, db.Integer), db.literal(1),
+            WaterLevel.distance, WaterLevel.water_level, WaterLevel.water_volume,
+            WaterLevel.water_level, WaterLevel.water_level
+        ),
+        'minute', device_id
+    )
+
+def compact_minute_aggregates(device_id, cutoff):
+    """Compact a device's minute aggregates older than `cutoff` into IST-day aggregates"""
+    batch = db.select(ReadingAggregate.id).where(
+        ReadingAggregate.device_id == device_id,
+        ReadingAggregate.period == 'minute',
+        ReadingAggregate.bucket_start < cutoff
+    ).order_by(ReadingAggregate.bucket_start.asc()).limit(RETENTION_BATCH_ROWS)
+    return compact_rows(
+        db.delete(ReadingAggregate).where(ReadingAggregate.id.in_(batch)).returning(
+            db.type_coerce(ReadingAggregate.bucket_start, db.Integer),
+            *(getattr(ReadingAggregate, column) for column in AGGREGATE_COLUMNS)
+        ),
+        'day', device_id
+    )
+
+def release_free_pages():
+    """Hand up to RETENTION_VACUUM_PAGES free pages back to the OS (incremental auto_vacuum only)"""
+    with db.engine.connect() as conn:
+        # executescript steps the pragma to completion, execute() would free a single page
+        conn.connection.executescript(f'PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})')
+
+def run_retention(now=None):
+    """Compact expired raw readings and minute aggregates, then release the freed pages"""
+    now = now or datetime.utcnow()
+    raw_cutoff = retention_cutoff(RETENTION_RAW_DAYS, now)
+    minute_cutoff = retention_cutoff(RETENTION_MINUTE_DAYS, now)
+
+    raw_moved = minutes_moved = 0
+    for device_id in device_ids():
+        raw_moved += compact_raw_readings(device_id, raw_cutoff) if raw_cutoff else 0
+        minutes_moved += compact_minute_aggregates(device_id, minute_cutoff) if minute_cutoff else 0
+    if raw_moved or minutes_moved:
+        release_free_pages()
+        logger.info(f"Retention compacted {raw_moved} readings and {minutes_moved} minute aggregates")
+    return raw_moved, minutes_moved
+
+retention_stop = threading.Event()
+retention_thread = None
+
+def retention_worker():
+    while not retention_stop.wait(RETENTION_INTERVAL):
+        with app.app_context():
+            try:
+                run_retention()
+            except Exception as e:
+                logger.error(f"Retention run failed: {e}")
+
+def start_retention_worker():
+    global retention_thread
+    if retention_thread is None and RETENTION_INTERVAL > 0:
+        retention_thread = threading.Thread(target=retention_worker, name='retention', daemon=True)
+        retention_thread.start()
+
+def data_tier(start_time, now):
+    """Finest tier ('raw', 'minute' or 'day') still holding everything since `start_time`"""
+    raw_cutoff = retention_cutoff(RETENTION_RAW_DAYS, now)
+    if raw_cutoff is None or start_time >= raw_cutoff:
+        return 'raw'
+    minute_cutoff = retention_cutoff(RETENTION_MINUTE_DAYS, now)
+    if minute_cutoff is None or start_time >= minute_cutoff:
+        return 'minute'
+    return 'day'
+
+# Same attributes as a READING_COLUMNS row, so the serializers take either
+AggregatePoint = namedtuple('AggregatePoint', 'id device_id epoch distance water_level water_volume status')
+
+def aggregate_window(period, device_id, start_time, end_time, since_time=None):
+    """Row filter for the tier tables, with the window widened to whole `period` buckets"""
+    start_time = UNIX_EPOCH + timedelta(seconds=bucket_of(period, calendar.timegm(start_time.utctimetuple())))
+
+    def in_range(model, column):
+        conditions = [model.device_id == device_id, column >= start_time, column <= end_time]
+        if since_time is not None:
+            conditions.append(column > since_time)
+        return conditions
+
+    return in_range
+
+def aggregate_version(period, device_id, start_time, end_time, since_time=None):
+    """Count, last id and newest time of every row aggregate_points() would read.
+
+    Index-only, so /api/data can answer a conditional request for an
+    aggregate tier without grouping anything. Compaction deletes the rows
+    it folds in, so it changes the counts as well.
+    """
+    in_range = aggregate_window(period, device_id, start_time, end_time, since_time)
+    periods = ['minute', 'day'] if period == 'day' else ['minute']
+    raw = db.session.execute(db.select(
+        db.func.count(WaterLevel.id),
+        db.func.max(WaterLevel.id),
+        db.func.max(WaterLevel.timestamp)
+    ).where(*in_range(WaterLevel, WaterLevel.timestamp))).one()
+    compacted = db.session.execute(db.select(
+        db.func.count(ReadingAggregate.id),
+        db.func.max(ReadingAggregate.id),
+        db.func.max(ReadingAggregate.bucket_start)
+    ).where(ReadingAggregate.period.in_(periods), *in_range(ReadingAggregate, ReadingAggregate.bucket_start))).one()
+    return (*raw, *compacted)
+
+def aggregate_points(period, device_id, start_time, end_time, since_time=None):
+    """Per-`period` averages of a device between the two times, from every tier holding data for them.
+
+    Readings that are not compacted yet (the recent raw rows, and minute
+    aggregates for the day tier) are grouped on the fly, so the result is
+    the same before and after a retention run. The window is widened to
+    whole buckets, as compacted ones can't be split.
+    """
+    in_range = aggregate_window(period, device_id, start_time, end_time, since_time)
+    raw_epoch = db.type_coerce(WaterLevel.timestamp, db.Integer)
+    sources = [
+        db.select(
+            bucket_of(period, raw_epoch).label('bucket'),
+            db.func.count(WaterLevel.id).label('reading_count'),
+            db.func.sum(WaterLevel.distance).label('distance_sum'),
+            db.func.sum(WaterLevel.water_level).label('level_sum'),
+            db.func.sum(WaterLevel.water_volume).label('volume_sum'),
+            db.func.min(WaterLevel.water_level).label('min_level'),
+            db.func.max(WaterLevel.water_level).label('max_level')
+        ).where(*in_range(WaterLevel, WaterLevel.timestamp)).group_by('bucket'),
+        db.select(
+            db.type_coerce(ReadingAggregate.bucket_start, db.Integer).label('bucket'),
+            *(getattr(ReadingAggregate, column) for column in AGGREGATE_COLUMNS)
+        ).where(ReadingAggregate.period == period, *in_range(ReadingAggregate, ReadingAggregate.bucket_start))
+    ]
+    if period == 'day':
+        minute_epoch = db.type_coerce(ReadingAggregate.bucket_start, db.Integer)
+        sources.append(db.select(
+            bucket_of('day', minute_epoch).label('bucket'),
+            db.func.sum(ReadingAggregate.reading_count),
+            db.func.sum(ReadingAggregate.distance_sum),
+            db.func.sum(ReadingAggregate.level_sum),
+            db.func.sum(ReadingAggregate.volume_sum),
+            db.func.min(ReadingAggregate.min_level),
+            db.func.max(ReadingAggregate.max_level)
+        ).where(ReadingAggregate.period == 'minute', *in_range(ReadingAggregate, ReadingAggregate.bucket_start)).group_by('bucket'))
+
+    combined = db.union_all(*sources).subquery()
+    rows = db.session.execute(
+        db.select(
+            combined.c.bucket,
+            db.func.sum(combined.c.reading_count),
+            db.func.sum(combined.c.distance_sum),
+            db.func.sum(combined.c.level_sum),
+            db.func.sum(combined.c.volume_sum)
+        ).group_by(combined.c.bucket).order_by(combined.c.bucket)
+    ).all()
+    return [
+        AggregatePoint(None, device_id, bucket, distance_sum / count, level_sum / count, volume_sum / count, 'aggregate')
+        for bucket, count, distance_sum, level_sum, volume_sum in rows
+    ]
+
 # Routes
 @app.route('/')
 def index():
@@ -170,87 +1257,606 @@ def calculate_data_checksum(data):
     sha256.update(json.dumps(data, sort_keys=True).encode('utf-8'))
     return sha256.hexdigest()
 
+DATA_VALUE_SCALE = 100  # Columnar values are sent as integers in hundredths
+
+# Reading columns for bulk reads, with the timestamp as raw epoch seconds
+READING_COLUMNS = (
+    WaterLevel.id,
+    WaterLevel.device_id,
+    db.type_coerce(WaterLevel.timestamp, db.Integer).label('epoch'),
+    WaterLevel.distance,
+    WaterLevel.water_level,
+    WaterLevel.water_volume,
+    WaterLevel.status
+)
+
+def format_ist(timestamp):
+    """Format a naive UTC timestamp as an IST string, like WaterLevel.to_dict()"""
+    return (timestamp + IST_OFFSET).strftime('%Y-%m-%d %H:%M:%S')
+
+def format_ist_epochs(epochs):
+    """format_ist() for a whole list of epoch seconds at once"""
+    local = (np.asarray(epochs, dtype='int64') + int(IST_OFFSET.total_seconds())).astype('datetime64[s]')
+    return [value.replace('T', ' ') for value in np.datetime_as_string(local).tolist()]
+
+def readings_to_dicts(rows):
+    """WaterLevel.to_dict() for rows of READING_COLUMNS, with the timestamps formatted in bulk"""
+    timestamps = format_ist_epochs([row.epoch for row in rows])
+    return [{
+        'id': row.id,
+        'device_id': row.device_id,
+        'timestamp': timestamp,
+        'distance': round(row.distance, 2),
+        'water_level': round(row.water_level, 2),
+        'water_volume': round(row.water_volume, 2),
+        'status': row.status
+    } for row, timestamp in zip(rows, timestamps)]
+
+def epoch_seconds(timestamp):
+    return timestamp.replace(tzinfo=pytz.UTC).timestamp()
+
+def delta_encode(values):
+    """[a, b, c] -> [a, b - a, c - b]"""
+    return [value - previous for previous, value in zip([0] + values[:-1], values)]
+
+def columnar_payload(readings):
+    """Parallel arrays instead of one object per reading.
+
+    `id` and `timestamp` (epoch seconds) are delta-encoded, so the client
+    rebuilds them with a running sum; the measurements are integers in units
+    of 1/`scale`.
+    """
+    return {
+        'format': 'columnar',
+        'count': len(readings),
+        'scale': DATA_VALUE_SCALE,
+        'id': delta_encode([r.id for r in readings]) if all(r.id is not None for r in readings) else None,
+        'timestamp': delta_encode([r.epoch for r in readings]),
+        'distance': [round(r.distance * DATA_VALUE_SCALE) for r in readings],
+        'water_level': [round(r.water_level * DATA_VALUE_SCALE) for r in readings],
+        'water_volume': [round(r.water_volume * DATA_VALUE_SCALE) for r in readings]
+    }
+
+def binary_response(readings, next_since_id):
+    """Little-endian float32 columns: all time offsets, then all water levels.
+
+    Offsets are seconds after X-Base-Timestamp (epoch seconds), so float32
+    keeps whole-second precision for windows of up to ~190 days.
+    """
+    base = readings[0].epoch if readings else 0
+    values = array('f', [r.epoch - base for r in readings])
+    values.extend(r.water_level for r in readings)
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return app.response_class(values.tobytes(), mimetype='application/octet-stream', headers={
+        'X-Count': str(len(readings)),
+        'X-Base-Timestamp': str(base),
+        'X-Columns': 'time_offset,water_level',
+        'X-Next-Since-Id': '' if next_since_id is None else str(next_since_id)
+    })
+
+def make_etag(*parts):
+    """Build an ETag from the cheap values that identify a response's content"""
+    return hashlib.sha1(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+def not_modified(etag):
+    """Return a 304 response if the client's If-None-Match already holds `etag`"""
+    if etag in request.if_none_match:
+        return with_etag(app.response_class(status=304), etag)
+    return None
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def day_rollups_etag(name, device_id, start):
+    """ETag for stats served from a device's day rollups starting at `start`"""
+    return make_etag(name, device_id, start, *db.session.query(
+        db.func.count(UsageRollup.id),
+        db.func.sum(UsageRollup.reading_count),
+        db.func.max(UsageRollup.last_reading_at)
+    ).filter(
+        UsageRollup.device_id == device_id,
+        UsageRollup.period == 'day',
+        UsageRollup.bucket_start >= start
+    ).one())
+
+def downsample_lttb(xs, ys, threshold):
+    """Pick `threshold` point indices with Largest-Triangle-Three-Buckets.
+
+    Keeps the first and last point and, for every bucket in between, the point
+    forming the largest triangle with the previously kept point and the
+    average of the next bucket, so spikes survive the downsampling.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    sampled = [0]
+
+    for i in range(threshold - 2):
+        # Average point of the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_len = avg_end - avg_start
+        avg_x = sum(xs[avg_start:avg_end]) / avg_len
+        avg_y = sum(ys[avg_start:avg_end]) / avg_len
+
+        # Point of the current bucket with the largest triangle area
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        max_area = -1
+        next_a = range_start
+        for j in range(range_start, range_end):
+            area = abs(
+                (xs[a] - avg_x) * (ys[j] - ys[a]) -
+                (xs[a] - xs[j]) * (avg_y - ys[a])
+            )
+            if area > max_area:
+                max_area = area
+                next_a = j
+
+        sampled.append(next_a)
+        a = next_a
+
+    sampled.append(n - 1)
+    return sampled
+
 @app.route('/api/data')
 def get_data():
+    """Return readings for the last `hours` hours.
+
+    Clients that already hold part of the window can pass `since_id` (or
+    `since_ts`, an IST timestamp as returned in `timestamp`) to receive only
+    the rows after it. `next_since_id`/`next_since_ts` carry the cursor for
+    the following poll. `max_points` downsamples the result with LTTB.
+    `format` is 'json' (default), 'columnar' or 'binary', see
+    columnar_payload() and binary_response(). Windows reaching past raw
+    retention return per-minute or per-day averages instead (`tier`).
+    `device` selects the tank, DEFAULT_DEVICE_ID if omitted.
+    """
     try:
         hours = request.args.get('hours', 24, type=int)
+        since_id = request.args.get('since_id', type=int)
+        since_ts = request.args.get('since_ts')
+        max_points = request.args.get('max_points', type=int)
+        if max_points is not None and max_points < 3:
+            return jsonify({'error': 'max_points must be at least 3, LTTB always keeps the first and last reading'}), 400
+        data_format = request.args.get('format', 'json')
+        if data_format not in ('json', 'columnar', 'binary'):
+            return jsonify({'error': 'format must be json, columnar or binary'}), 400
+        device_id, device = request_device()
+        if device is None:
+            return unknown_device(device_id)
         end_time = datetime.now(pytz.UTC)
         start_time = end_time - timedelta(hours=hours)
-        
-        logger.info(f"Fetching data for last {hours} hours from {start_time}")
 
-        readings = WaterLevel.query.filter(
-            WaterLevel.timestamp >= start_time,
-            WaterLevel.timestamp <= end_time
-        ).order_by(WaterLevel.timestamp.asc()).all()  # Changed to ascending order
-
-        logger.info(f"Found {len(readings)} readings")
+        since_time = None
+        if since_ts and since_id is None:
+            try:
+                since_time = pytz.timezone('Asia/Kolkata').localize(
+                    datetime.strptime(since_ts, '%Y-%m-%d %H:%M:%S')
+                ).astimezone(pytz.UTC)
+            except ValueError:
+                return jsonify({'error': 'since_ts must be formatted as YYYY-MM-DD HH:MM:SS'}), 400
+
+        # Ranges older than raw retention come from the aggregate tiers
+        tier = data_tier(start_time.replace(tzinfo=None), end_time.replace(tzinfo=None))
+        if tier != 'raw':
+            if since_id is not None:
+                return jsonify({
+                    'error': f'since_id only works within the last {RETENTION_RAW_DAYS} days, use since_ts'
+                }), 400
+            hot_path_logger.info(f"Fetching {tier} aggregates for last {hours} hours")
+            etag = make_etag(
+                'data', device_id, tier, data_format, hours, since_ts, max_points,
+                *aggregate_version(tier, device_id, start_time, end_time, since_time)
+            )
+        else:
+            query = WaterLevel.query.filter(
+                WaterLevel.device_id == device_id,
+                WaterLevel.timestamp >= start_time,
+                WaterLevel.timestamp <= end_time
+            )
 
-        response_data = [reading.to_dict() for reading in readings]
+            if since_id is not None:
+                hot_path_logger.info(f"Fetching data for last {hours} hours after id {since_id}")
+                query = query.filter(WaterLevel.id > since_id)
+                order = WaterLevel.id.asc()
+            else:
+                if since_time:
+                    hot_path_logger.info(f"Fetching data for last {hours} hours after {since_time}")
+                    query = query.filter(WaterLevel.timestamp > since_time)
+                else:
+                    hot_path_logger.info(f"Fetching data for last {hours} hours from {start_time}")
+                order = WaterLevel.timestamp.asc()  # Changed to ascending order
+
+            # Validator from an index-only aggregate, answered before any row is loaded
+            etag = make_etag(
+                'data', device_id, data_format, hours, since_id, since_ts, max_points,
+                *query.with_entities(
+                    db.func.count(WaterLevel.id),
+                    db.func.min(WaterLevel.id),
+                    db.func.max(WaterLevel.id),
+                    db.func.max(WaterLevel.timestamp)
+                ).one()
+            )
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        if tier == 'raw':
+            readings = query.with_entities(*READING_COLUMNS).order_by(order).all()
+        else:
+            readings = aggregate_points(tier, device_id, start_time, end_time, since_time)
+
+        if max_points and len(readings) > max_points:
+            keep = downsample_lttb(
+                [r.epoch for r in readings],
+                [r.water_level for r in readings],
+                max_points
+            )
+            readings = [readings[i] for i in keep]
+
+        if data_format != 'json':
+            next_since_id = max((r.id for r in readings if r.id is not None), default=since_id)
+            last_epoch = max((r.epoch for r in readings), default=None)
+            next_since_ts = format_ist_epochs([last_epoch])[0] if last_epoch is not None else since_ts
+            hot_path_logger.info(
+                f"Returning {len(readings)} readings as {data_format}",
+                extra={'hours': hours, 'rows': len(readings), 'since_id': since_id}
+            )
+            if data_format == 'binary':
+                return with_etag(binary_response(readings, next_since_id), etag)
+            return with_etag(jsonify(dict(
+                columnar_payload(readings),
+                success=True,
+                tier=tier,
+                next_since_id=next_since_id,
+                next_since_ts=next_since_ts
+            )), etag)
+
+        response_data = readings_to_dicts(readings)
         checksum = calculate_data_checksum(response_data)
-        logger.info(f"Returning {len(response_data)} readings with checksum {checksum}")
-        return jsonify({
+        hot_path_logger.info(
+            f"Returning {len(response_data)} readings with checksum {checksum}",
+            extra={'hours': hours, 'rows': len(response_data), 'since_id': since_id}
+        )
+
+        next_since_id = max((r['id'] for r in response_data if r['id'] is not None), default=since_id)
+        next_since_ts = max((r['timestamp'] for r in response_data), default=since_ts)
+
+        return with_etag(jsonify({
             'success': True,
+            'tier': tier,
             'data': response_data,
-            'checksum': checksum
-        })
+            'checksum': checksum,
+            'next_since_id': next_since_id,
+            'next_since_ts': next_since_ts
+        }), etag)
 
     except Exception as e:
         logger.error(f"Error fetching data: {e}")
         return jsonify({'error': str(e)}), 500
 
+def parse_ist_datetime(value):
+    """Parse 'YYYY-MM-DD[ HH:MM:SS]' in IST into an aware UTC datetime"""
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return pytz.timezone('Asia/Kolkata').localize(parsed).astimezone(pytz.UTC)
+    raise ValueError(f'Invalid date: {value}. Use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS')
+
+@app.route('/api/export')
+def export_data():
+    """Stream a device's readings between `from` and `to` (IST) as CSV or NDJSON"""
+    try:
+        export_format = request.args.get('format', 'csv')
+        if export_format not in ('csv', 'ndjson'):
+            return jsonify({'error': 'format must be csv or ndjson'}), 400
+        device_id, device = request_device()
+        if device is None:
+            return unknown_device(device_id)
+
+        try:
+            start_time = parse_ist_datetime(request.args['from']) if request.args.get('from') else None
+            end_time = parse_ist_datetime(request.args['to']) if request.args.get('to') else datetime.now(pytz.UTC)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        query = WaterLevel.query.filter(WaterLevel.device_id == device_id, WaterLevel.timestamp <= end_time)
+        if start_time:
+            query = query.filter(WaterLevel.timestamp >= start_time)
+        query = query.with_entities(*READING_COLUMNS).order_by(WaterLevel.timestamp.asc())
+
+        fields = ['id', 'device_id', 'timestamp', 'distance', 'water_level', 'water_volume', 'status']
+
+        def encode_chunks():
+            buffer = io.StringIO()
+            if export_format == 'csv':
+                writer = csv.DictWriter(buffer, fieldnames=fields)
+                writer.writeheader()
+
+            count = 0
+            result = db.session.execute(query.statement.execution_options(yield_per=EXPORT_CHUNK_ROWS))
+            for rows in result.partitions():
+                for reading in readings_to_dicts(rows):
+                    if export_format == 'csv':
+                        writer.writerow(reading)
+                    else:
+                        buffer.write(json.dumps(reading) + '\n')
+                count += len(rows)
+
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+
+            yield buffer.getvalue().encode('utf-8')
+            logger.info(f"Exported {count} readings as {export_format}")
+
+        def gzip_chunks(chunks):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip container
+            for chunk in chunks:
+                compressed = compressor.compress(chunk)
+                if compressed:
+                    yield compressed
+            yield compressor.flush()
+
+        body = encode_chunks()
+        headers = {
+            'Content-Disposition': f'attachment; filename=water_levels_{secure_filename(device_id)}.{export_format}'
+        }
+        if 'gzip' in request.accept_encodings:
+            body = gzip_chunks(body)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+
+    except Exception as e:
+        logger.error(f"Error exporting data: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/latest')
+def get_latest():
+    """Return a device's most recent reading, from the in-memory ring buffer when it is there"""
+    try:
+        device_id, device = request_device()
+        if device is None:
+            return unknown_device(device_id)
+
+        sync_recent_readings()
+        with recent_readings_lock:
+            # By time, a batch may have stored a slightly older reading after it
+            latest = max(
+                (r for r in recent_readings if r['device_id'] == device_id),
+                key=lambda r: (r['timestamp'], r['id']),
+                default=None
+            )
+        if latest is None:
+            # Nothing from this device among the buffered readings of all devices
+            reading = WaterLevel.query.filter_by(device_id=device_id).order_by(WaterLevel.timestamp.desc()).first()
+            latest = reading.to_dict() if reading else None
+
+        return jsonify({
+            'success': True,
+            'data': latest
+        })
+
+    except Exception as e:
+        logger.error(f"Error fetching latest reading: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # Update the weekly stats route for more accurate data
 @app.route('/api/stats/weekly')
 def get_weekly_stats():
     try:
-        end_date = datetime.now(pytz.UTC)
-        start_date = end_date - timedelta(days=7)
+        ist = pytz.timezone('Asia/Kolkata')
+        ist_start_of_day = datetime.now(ist).replace(hour=0, minute=0, second=0, microsecond=0)
+        start_date = (ist_start_of_day - timedelta(days=7)).astimezone(pytz.UTC)
+        device_id, device = request_device()
+        if device is None:
+            return unknown_device(device_id)
+
+        etag = day_rollups_etag('weekly', device_id, start_date)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        # Today and the seven IST days before it, straight from the rollups
+        rollups = UsageRollup.query.filter(
+            UsageRollup.device_id == device_id,
+            UsageRollup.period == 'day',
+            UsageRollup.bucket_start >= start_date
+        ).order_by(UsageRollup.bucket_start.asc()).all()
+
+        daily_stats = [{
+            'date': rollup.bucket_start.replace(tzinfo=pytz.UTC).astimezone(ist).strftime('%Y-%m-%d'),
+            'avg_level': round(rollup.avg_level, 2),
+            'max_level': round(rollup.max_level, 2),
+            'min_level': round(rollup.min_level, 2),
+            'consumption': round(rollup.consumption, 2),
+            'readings_count': rollup.reading_count
+        } for rollup in rollups]
+
+        return with_etag(jsonify({
+            'success': True,
+            'data': daily_stats
+        }), etag)
 
-        daily_stats = []
-        current_date = start_date
+    except Exception as e:
+        logger.error(f"Error fetching weekly stats: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
 
-        while current_date <= end_date:
-            next_date = current_date + timedelta(days=1)
-            
-            # Get all readings for the day
-            readings = WaterLevel.query.filter(
-                WaterLevel.timestamp >= current_date,
-                WaterLevel.timestamp < next_date
-            ).order_by(WaterLevel.timestamp.asc()).all()
-
-            if readings:
-                # Calculate more accurate daily statistics
-                day_readings = []
-                last_reading = None
-                total_consumption = 0
-
-                for reading in readings:
-                    if last_reading:
-                        # Calculate consumption between readings
-                        if reading.water_level < last_reading.water_level:
-                            consumption = (last_reading.water_level - reading.water_level) * LITERS_PER_CM
-                            total_consumption += consumption
-                    last_reading = reading
-                    day_readings.append(reading.water_level)
-
-                daily_stats.append({
-                    'date': current_date.strftime('%Y-%m-%d'),
-                    'avg_level': round(sum(day_readings) / len(day_readings), 2),
-                    'max_level': round(max(day_readings), 2),
-                    'min_level': round(min(day_readings), 2),
-                    'consumption': round(total_consumption, 2),
-                    'readings_count': len(readings)
-                })
-
-            current_date = next_date
+def format_sse(event, event_id, data):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/stream')
+def stream_events():
+    """Server-Sent Events: a 'reading' event per new reading of `device`, then a 'stats' event with today's counters.
+
+    Event ids are reading ids. A client reconnecting with Last-Event-ID (or
+    `last_event_id`) first gets the readings it missed from the in-memory
+    buffer, or a 'resync' event when they are no longer all there.
+    """
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID must be a reading id'}), 400
+    device_id, device = request_device()
+    if device is None:
+        return unknown_device(device_id)
+
+    if event_broadcaster.subscriber_count() >= SSE_MAX_CLIENTS:
+        return jsonify({'error': 'Too many open streams, poll instead'}), 503, {'Retry-After': '30'}
+
+    # Subscribe before taking the backlog so nothing falls in between
+    subscription = event_broadcaster.subscribe()
+    with recent_readings_lock:
+        # Readings above the synced id may still have gaps, they come through the broadcast
+        buffered = [r for r in recent_readings if r['id'] <= recent_synced_id]
+    backlog, resync = [], False
+    if last_event_id is not None:
+        backlog = [r for r in buffered if r['id'] > last_event_id and r['device_id'] == device_id]
+        resync = bool(buffered) and buffered[0]['id'] > last_event_id + 1
+
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+            sent_id = last_event_id or 0
+            if resync:
+                yield format_sse('resync', buffered[-1]['id'], {})
+                sent_id = buffered[-1]['id']
+            else:
+                for reading in backlog:
+                    yield format_sse('reading', reading['id'], reading)
+                    sent_id = reading['id']
+
+            while True:
+                try:
+                    item = subscription.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if item is None:
+                    return
+                event, event_id, data = item
+                if data.get('device_id', device_id) != device_id:
+                    continue
+                if event == 'reading':
+                    if event_id <= sent_id:
+                        continue  # Already sent from the backlog
+                    sent_id = event_id
+                yield format_sse(event, event_id, data)
+        finally:
+            event_broadcaster.unsubscribe(subscription)
+
+    response = Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Don't let a proxy hold events back
+    })
+    # Frees the slot even when the body is never iterated, e.g. for HEAD
+    response.call_on_close(lambda: event_broadcaster.unsubscribe(subscription))
+    return response
+
+@app.route('/api/devices', methods=['GET', 'POST'])
+def handle_devices():
+    """List the registered tanks, or register one / change its geometry.
+
+    New geometry applies to readings received from then on; stored readings
+    and rollups keep the values they were computed with.
+    """
+    try:
+        if request.method == 'GET':
+            devices = Device.query.order_by(Device.id).all()
+            return jsonify({'success': True, 'data': [device.to_dict() for device in devices]})
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not data.get('device_id'):
+            return jsonify({'error': 'device_id is required'}), 400
+        device_id = str(data['device_id'])
+        if len(device_id) > 50:
+            return jsonify({'error': 'device_id must be at most 50 characters'}), 400
+
+        device = db.session.get(Device, device_id)
+        created = device is None
+        if created:
+            device = Device(id=device_id, min_distance=MIN_DISTANCE, max_distance=MAX_DISTANCE, liters_per_cm=LITERS_PER_CM)
+
+        try:
+            for key in ('min_distance', 'max_distance', 'liters_per_cm'):
+                if key in data:
+                    setattr(device, key, float(data[key]))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'min_distance, max_distance and liters_per_cm must be numbers'}), 400
+        if not (0 <= device.min_distance < device.max_distance) or device.liters_per_cm <= 0:
+            return jsonify({'error': 'Need 0 <= min_distance < max_distance and liters_per_cm > 0'}), 400
+        if 'name' in data:
+            device.name = data['name']
+
+        if created:
+            db.session.add(device)
+        db.session.commit()
+        device_cache.pop(device_id, None)
+        logger.info(f"{'Registered' if created else 'Updated'} device {device_id}")
+
+        return jsonify({'success': True, 'data': device.to_dict()}), 201 if created else 200
+
+    except Exception as e:
+        logger.error(f"Error handling devices: {e}")
+        db.session.rollback()
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/events')
+def get_events():
+    """A device's usage and refill events, newest first, with the one in progress.
+
+    `kind` ('usage' or 'refill') narrows the list, `from`/`to` (IST) bound
+    the event starts and `limit` caps the count (default 100).
+    """
+    try:
+        device_id, device = request_device()
+        if device is None:
+            return unknown_device(device_id)
+
+        kind = request.args.get('kind')
+        if kind not in (None, 'usage', 'refill'):
+            return jsonify({'error': 'kind must be usage or refill'}), 400
+        limit = min(max(request.args.get('limit', 100, type=int), 1), MAX_EVENTS_LIMIT)
+        try:
+            start_time = parse_ist_datetime(request.args['from']) if request.args.get('from') else None
+            end_time = parse_ist_datetime(request.args['to']) if request.args.get('to') else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        query = TankEvent.query.filter(TankEvent.device_id == device_id)
+        if kind:
+            query = query.filter(TankEvent.kind == kind)
+        if start_time:
+            query = query.filter(TankEvent.started_at >= start_time)
+        if end_time:
+            query = query.filter(TankEvent.started_at <= end_time)
+        events = query.order_by(TankEvent.started_at.desc()).limit(limit).all()
+
+        state = db.session.get(EventDetectorState, device_id)
+        current = state.to_dict() if state else None
 
         return jsonify({
             'success': True,
-            'data': daily_stats
+            'data': [event.to_dict() for event in events],
+            'current': current if current and kind in (None, current['kind']) else None
         })
 
     except Exception as e:
-        logger.error(f"Error fetching weekly stats: {e}")
+        logger.error(f"Error fetching events: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/settings', methods=['GET', 'POST'])
@@ -289,6 +1895,134 @@ def handle_settings():
         db.session.rollback()
         return jsonify({'error': 'Internal server error'}), 500
 
+def calculate_level_and_volume(distance, device):
+    """Convert a sensor distance into (water_level %, water_volume L) for the device's tank"""
+    # Improved water level calculation
+    usable_height = device.max_distance - device.min_distance
+    water_level = ((device.max_distance - distance) / usable_height) * 100
+    water_level = max(0, min(100, water_level))  # Clamp between 0 and 100
+
+    # Calculate volume based on actual water height
+    water_height = device.max_distance - distance
+    water_volume = max(0, water_height * device.liters_per_cm)
+    return water_level, water_volume
+
+def calculate_levels_and_volumes(distances, device):
+    """calculate_level_and_volume for a list of distances at once, as two lists"""
+    water_height = device.max_distance - np.asarray(distances, dtype=float)
+    water_levels = np.clip(water_height / (device.max_distance - device.min_distance) * 100, 0, 100)
+    water_volumes = np.maximum(0, water_height * device.liters_per_cm)
+    return water_levels.tolist(), water_volumes.tolist()
+
+def parse_sample_timestamp(value, now, oldest=None):
+    """Parse a device timestamp (epoch seconds or 'YYYY-MM-DD HH:MM:SS' UTC), no earlier than `oldest`"""
+    if value is None:
+        return now
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        timestamp = datetime.fromtimestamp(value, pytz.UTC)
+    else:
+        timestamp = pytz.UTC.localize(datetime.strptime(str(value), '%Y-%m-%d %H:%M:%S'))
+    if timestamp > now + timedelta(minutes=1):
+        raise ValueError('Timestamp is in the future')
+    if oldest is not None and timestamp < oldest:
+        raise ValueError(
+            f'Timestamp is more than {BATCH_MAX_BACKDATE} seconds older than the newest reading of the device'
+        )
+    return timestamp
+
+def store_readings(rows):
+    """Insert reading rows (dicts, in time order) and their rollups in one transaction.
+
+    Returns the serialized readings. Publish them with
+    publish_stored_readings() afterwards, outside any retry of this call.
+    """
+    # Inserted a page of rows per statement. SQLite numbers each statement's
+    # rows in order, so sorting by id gives back the order of `rows`
+    readings = sorted(
+        db.session.scalars(db.insert(WaterLevel).returning(WaterLevel), rows).all(),
+        key=lambda reading: reading.id
+    )
+    by_device = {}
+    for reading in readings:
+        by_device.setdefault(reading.device_id, []).append(reading)
+    for device_id, device_readings in by_device.items():
+        device = get_device(device_id)
+        apply_readings_to_rollups(device, device_readings)
+        apply_readings_to_events(device, device_readings)
+    stored = [reading.to_dict() for reading in readings]  # Before the commit expires them
+    db.session.commit()
+    return stored
+
+def publish_stored_readings(stored):
+    """Push committed readings to the ring buffer and the open streams.
+
+    Best effort: the readings are already stored, so a failure here is only
+    logged and must not make the caller report them as lost. The buffer and
+    the streams catch up on the next sync_recent_readings().
+    """
+    try:
+        for reading_data in stored:
+            push_recent_reading(reading_data)
+        stream_new_readings()
+    except Exception as e:
+        logger.error(f"Error publishing {len(stored)} stored readings: {e}")
+
+# Write-behind ingest queue, only used when INGEST_MODE is 'queued'
+ingest_queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+ingest_stop = threading.Event()
+ingest_thread = None
+
+def flush_ingest_queue(timeout):
+    """Group-commit up to INGEST_FLUSH_ROWS queued rows collected within `timeout` seconds"""
+    try:
+        rows = [ingest_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return 0
+
+    deadline = time.monotonic() + timeout
+    while len(rows) < INGEST_FLUSH_ROWS:
+        try:
+            rows.append(ingest_queue.get(timeout=max(0, deadline - time.monotonic())))
+        except queue.Empty:
+            break
+
+    with app.app_context():
+        # Only the transaction is retried, a retry after the commit would store the rows twice
+        for attempt in range(3):
+            try:
+                stored = store_readings(rows)
+                break
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error writing {len(rows)} queued readings (attempt {attempt + 1}): {e}")
+                time.sleep(0.1 * (attempt + 1))
+        else:
+            logger.error(f"Dropped {len(rows)} queued readings")
+            return 0
+        publish_stored_readings(stored)
+    return len(rows)
+
+def ingest_writer():
+    while not ingest_stop.is_set():
+        flush_ingest_queue(INGEST_FLUSH_INTERVAL)
+    # Drain whatever is left on shutdown, past any group that fails
+    while not ingest_queue.empty():
+        flush_ingest_queue(0)
+
+def start_ingest_writer():
+    global ingest_thread
+    if ingest_thread is None:
+        ingest_thread = threading.Thread(target=ingest_writer, name='ingest-writer', daemon=True)
+        ingest_thread.start()
+        atexit.register(stop_ingest_writer)
+        logger.info(f"Queued ingest enabled (flush every {INGEST_FLUSH_INTERVAL}s or {INGEST_FLUSH_ROWS} rows)")
+
+def stop_ingest_writer():
+    """Stop the background writer after flushing the queue"""
+    if ingest_thread is not None:
+        ingest_stop.set()
+        ingest_thread.join(timeout=30)
+
 @app.route('/update', methods=['POST'])
 def update_water_level():
     try:
@@ -301,25 +2035,52 @@ def update_water_level():
         except ValueError:
             return jsonify({'error': 'Distance must be a number'}), 400
 
-        if not (MIN_DISTANCE <= distance <= MAX_DISTANCE):
-            logger.warning(f"Invalid distance value received: {distance}")
+        device_id, device = request_device(data)
+        if device is None:
+            metrics.INGEST_READINGS.labels('update', 'rejected').inc()
+            return unknown_device(device_id)
+
+        if not (device.min_distance <= distance <= device.max_distance):
+            hot_path_logger.warning(f"Invalid distance value received: {distance}", extra={'distance': distance, 'device_id': device_id})
+            metrics.INGEST_READINGS.labels('update', 'rejected').inc()
             return jsonify({
-                'error': f'Invalid distance value: {distance}. Must be between {MIN_DISTANCE} and {MAX_DISTANCE} cm'
+                'error': f'Invalid distance value: {distance}. Must be between {device.min_distance} and {device.max_distance} cm'
             }), 400
 
-        # Improved water level calculation
-        usable_height = MAX_DISTANCE - MIN_DISTANCE
-        water_level = ((MAX_DISTANCE - distance) / usable_height) * 100
-        water_level = max(0, min(100, water_level))  # Clamp between 0 and 100
-        
-        # Calculate volume based on actual water height
-        water_height = MAX_DISTANCE - distance
-        water_volume = max(0, water_height * LITERS_PER_CM)
+        water_level, water_volume = calculate_level_and_volume(distance, device)
+        hot_path_logger.info(
+            f"Received distance {distance} cm ({water_level:.2f}%) from {device_id}",
+            extra={'device_id': device_id, 'distance': distance, 'water_level': round(water_level, 2), 'mode': INGEST_MODE}
+        )
 
-        # Use UTC for timestamp
-        current_time = datetime.now(pytz.UTC)
+        # Use UTC for timestamp, in whole seconds as stored
+        current_time = datetime.now(pytz.UTC).replace(microsecond=0)
+
+        if INGEST_MODE == 'queued':
+            row = {
+                'device_id': device_id,
+                'timestamp': current_time,
+                'distance': round(distance, 2),
+                'water_level': round(water_level, 2),
+                'water_volume': round(water_volume, 2),
+                'status': 'valid'
+            }
+            try:
+                ingest_queue.put_nowait(row)
+            except queue.Full:
+                hot_path_logger.warning("Ingest queue full, rejecting reading", extra={'device_id': device_id})
+                metrics.INGEST_READINGS.labels('update', 'rejected').inc()
+                return jsonify({'error': 'Ingest queue full, retry later'}), 503, {'Retry-After': '1'}
+
+            metrics.INGEST_READINGS.labels('update', 'accepted').inc()
+            return jsonify({
+                'success': True,
+                'queued': True,
+                'data': dict(row, timestamp=format_ist(current_time.replace(tzinfo=None)))
+            }), 202
         
         new_reading = WaterLevel(
+            device_id=device_id,
             timestamp=current_time,
             distance=round(distance, 2),
             water_level=round(water_level, 2),
@@ -328,11 +2089,18 @@ def update_water_level():
         )
 
         db.session.add(new_reading)
+        db.session.flush()
+        apply_reading_to_rollups(device, current_time, new_reading.water_level)
+        apply_readings_to_events(device, [new_reading])
+        reading_data = new_reading.to_dict()
         db.session.commit()
 
+        publish_stored_readings([reading_data])
+        metrics.INGEST_READINGS.labels('update', 'accepted').inc()
+
         return jsonify({
             'success': True,
-            'data': new_reading.to_dict()
+            'data': reading_data
         })
 
     except Exception as e:
@@ -340,11 +2108,96 @@ def update_water_level():
         logger.error(f"Error updating water level: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/update/batch', methods=['POST'])
+def update_water_level_batch():
+    """Store a buffered list of {distance, timestamp} samples of one device in one transaction"""
+    try:
+        samples = request.get_json(silent=True)
+        device_id, device = request_device(samples if isinstance(samples, dict) else None)
+        if device is None:
+            return unknown_device(device_id)
+        if isinstance(samples, dict):
+            samples = samples.get('readings')
+        if not isinstance(samples, list) or not samples:
+            return jsonify({'error': 'Expected a non-empty list of readings'}), 400
+        if len(samples) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'Batch too large: at most {MAX_BATCH_SIZE} readings per request'}), 413
+
+        now = datetime.now(pytz.UTC)
+        newest = db.session.query(db.func.max(WaterLevel.timestamp)).filter(WaterLevel.device_id == device_id).scalar()
+        oldest = pytz.UTC.localize(newest) - timedelta(seconds=BATCH_MAX_BACKDATE) if newest else None
+        results = [None] * len(samples)
+        rows = []
+        distances = []
+        indexes = []
+
+        for index, sample in enumerate(samples):
+            try:
+                if not isinstance(sample, dict) or 'distance' not in sample:
+                    raise ValueError('Missing distance data')
+                distance = float(sample['distance'])
+                if not (device.min_distance <= distance <= device.max_distance):
+                    raise ValueError(
+                        f'Invalid distance value: {distance}. Must be between {device.min_distance} and {device.max_distance} cm'
+                    )
+                timestamp = parse_sample_timestamp(sample.get('timestamp'), now, oldest)
+            except (TypeError, ValueError, OverflowError, OSError) as e:
+                results[index] = {'index': index, 'success': False, 'error': str(e)}
+                continue
+
+            rows.append({
+                'device_id': device_id,
+                'timestamp': timestamp,
+                'distance': round(distance, 2),
+                'status': 'valid'
+            })
+            distances.append(distance)
+            indexes.append(index)
+
+        for row, water_level, water_volume in zip(rows, *calculate_levels_and_volumes(distances, device)):
+            row['water_level'] = round(water_level, 2)
+            row['water_volume'] = round(water_volume, 2)
+
+        rejected = len(samples) - len(rows)
+        if rejected:
+            hot_path_logger.warning(f"Rejected {rejected} of {len(samples)} batched readings")
+            metrics.INGEST_READINGS.labels('batch', 'rejected').inc(rejected)
+
+        if rows:
+            # Insert in time order so ids follow timestamps
+            order = sorted(range(len(rows)), key=lambda i: rows[i]['timestamp'])
+            rows = [rows[i] for i in order]
+            indexes = [indexes[i] for i in order]
+
+            stored = store_readings(rows)
+            publish_stored_readings(stored)
+            for index, reading_data in zip(indexes, stored):
+                results[index] = {'index': index, 'success': True, 'id': reading_data['id']}
+            metrics.INGEST_READINGS.labels('batch', 'accepted').inc(len(rows))
+
+        return jsonify({
+            'success': True,
+            'accepted': len(rows),
+            'rejected': rejected,
+            'results': results
+        })
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error storing batched water levels: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus scrape endpoint, totals over all workers"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
 @app.route('/api/health')
 def health_check():
     try:
         # Check database connection
-        db.session.execute('SELECT 1')
+        db.session.execute(db.text('SELECT 1'))
         db_status = 'connected'
         
         return jsonify({
@@ -368,22 +2221,9 @@ def get_weather():
         if not OPENWEATHER_API_KEY:
             logger.error("OpenWeather API key not configured")
             return jsonify({'error': "Weather API key not configured"}), 500
-            
-        params = {
-            'lat': LOCATION_LAT,
-            'lon': LOCATION_LON,
-            'appid': OPENWEATHER_API_KEY,
-            'units': 'metric'  # For Celsius
-        }
-        
-        logger.info(f"Fetching weather data with params: {params}")
-        
+
         try:
-            response = requests.get(WEATHER_API_URL, params=params, timeout=5)
-            response.raise_for_status()
-            weather_data = response.json()
-            
-            logger.info(f"Raw weather response: {weather_data}")
+            weather_data = weather_cache.get()
             
             formatted_weather = {
                 'location': LOCATION_NAME,
@@ -398,7 +2238,7 @@ def get_weather():
                 'sunset': datetime.fromtimestamp(weather_data['sys']['sunset']).strftime('%H:%M')
             }
             
-            logger.info(f"Formatted weather data: {formatted_weather}")
+            logger.debug(f"Formatted weather data: {formatted_weather}")
             return jsonify(formatted_weather)
             
         except requests.RequestException as e:
@@ -449,7 +2289,10 @@ def map_weather_icon(openweather_icon):
 @app.route('/debug/data')
 def debug_data():
     try:
-        readings = WaterLevel.query.order_by(WaterLevel.timestamp.desc()).limit(5).all()
+        query = WaterLevel.query
+        if request.args.get('device'):
+            query = query.filter_by(device_id=request.args['device'])
+        readings = query.order_by(WaterLevel.timestamp.desc()).limit(5).all()
         return jsonify({
             'success': True,
             'count': len(readings),
@@ -461,6 +2304,7 @@ def debug_data():
 # Update the erase_data route to check password and clear all data
 @app.route('/api/data/erase', methods=['POST'])
 def erase_data():
+    global recent_synced_id
     try:
         data = request.get_json()
         if not data or data.get('password') != 'AS95as95@#':
@@ -471,7 +2315,14 @@ def erase_data():
 
         # Delete all water level readings
         WaterLevel.query.delete()
+        UsageRollup.query.delete()
+        ReadingAggregate.query.delete()
+        TankEvent.query.delete()
+        EventDetectorState.query.delete()
         db.session.commit()
+        with recent_readings_lock:
+            recent_readings.clear()
+            recent_synced_id = 0
         
         logger.info("All water level data erased successfully")
         return jsonify({
@@ -483,6 +2334,48 @@ def erase_data():
         logger.error(f"Error erasing data: {e}")
         return jsonify({'error': 'Failed to erase data'}), 500
 
+def daily_stats_payload(utc_start_of_day=None, device_id=DEFAULT_DEVICE_ID):
+    """A device's usage today, its 7-day average and today's last refill/update times"""
+    ist = pytz.timezone('Asia/Kolkata')
+    if utc_start_of_day is None:
+        utc_start_of_day = datetime.now(ist).replace(hour=0, minute=0, second=0, microsecond=0).astimezone(pytz.UTC)
+    week_ago = utc_start_of_day - timedelta(days=7)
+
+    # Today's rollup plus the seven before it
+    rollups = UsageRollup.query.filter(
+        UsageRollup.device_id == device_id,
+        UsageRollup.period == 'day',
+        UsageRollup.bucket_start >= week_ago
+    ).all()
+
+    daily_usage = 0
+    weekly_usage = [0] * 7
+    last_refill = "No refill"
+    last_update = "No update"
+
+    for rollup in rollups:
+        start = rollup.bucket_start.replace(tzinfo=pytz.UTC)
+        if start < utc_start_of_day:
+            weekly_usage[(start - week_ago).days] = rollup.consumption
+            continue
+
+        daily_usage = rollup.consumption
+        if rollup.last_refill_at:
+            last_refill = rollup.last_refill_at.replace(tzinfo=pytz.UTC).astimezone(ist).strftime('%H:%M')
+        last_update = rollup.last_reading_at.replace(tzinfo=pytz.UTC).astimezone(ist).strftime('%H:%M')
+
+    # Calculate weekly average
+    weekly_avg = sum(weekly_usage) / len(weekly_usage)
+
+    return {
+        'success': True,
+        'device_id': device_id,
+        'daily_usage': round(daily_usage, 2),
+        'weekly_avg': round(weekly_avg, 2),
+        'last_refill': last_refill,
+        'last_update': last_update
+    }
+
 # Update the get_daily_stats function to handle accurate data usage calculation
 @app.route('/api/stats/daily')
 def get_daily_stats():
@@ -494,71 +2387,17 @@ def get_daily_stats():
         
         # Convert to UTC for database query
         utc_start_of_day = ist_start_of_day.astimezone(pytz.UTC)
-        
-        # Get today's readings
-        readings = WaterLevel.query.filter(
-            WaterLevel.timestamp >= utc_start_of_day
-        ).order_by(WaterLevel.timestamp.asc()).all()
-
-        # Calculate daily usage from drops in water level
-        daily_usage = 0
-        last_level = None
-        last_refill = "No refill"
-        
-        for reading in readings:
-            current_level = reading.water_level
-            
-            if last_level is not None:
-                # Check for water usage (level decrease)
-                if current_level < last_level:
-                    usage = (last_level - current_level) * LITERS_PER_CM
-                    daily_usage += usage
-                # Check for refill (level increase)
-                elif current_level > last_level + 1:  # +1 to avoid minor fluctuations
-                    ist_time = reading.timestamp.replace(tzinfo=pytz.UTC).astimezone(ist)
-                    last_refill = ist_time.strftime('%H:%M')
-            
-            last_level = current_level
-
-        # Calculate weekly average
         week_ago = utc_start_of_day - timedelta(days=7)
-        weekly_usage = []
-        
-        # Calculate usage for each of the last 7 days
-        for day in range(7):
-            day_start = week_ago + timedelta(days=day)
-            day_end = day_start + timedelta(days=1)
-            
-            day_readings = WaterLevel.query.filter(
-                WaterLevel.timestamp >= day_start,
-                WaterLevel.timestamp < day_end
-            ).order_by(WaterLevel.timestamp.asc()).all()
-            
-            day_usage = 0
-            last_level = None
-            
-            for reading in day_readings:
-                if last_level is not None and reading.water_level < last_level:
-                    day_usage += (last_level - reading.water_level) * LITERS_PER_CM
-                last_level = reading.water_level
-            
-            weekly_usage.append(day_usage)
+        device_id, device = request_device()
+        if device is None:
+            return unknown_device(device_id)
 
-        # Calculate weekly average
-        weekly_avg = sum(weekly_usage) / len(weekly_usage) if weekly_usage else 0
+        etag = day_rollups_etag('daily', device_id, week_ago)
+        cached = not_modified(etag)
+        if cached:
+            return cached
 
-        # Get last update time
-        last_update = "No update"
-        if readings:
-            last_update = readings[-1].timestamp.replace(tzinfo=pytz.UTC).astimezone(ist).strftime('%H:%M')
-
-        return jsonify({
-            'success': True,
-            'daily_usage': round(daily_usage, 2),
-            'weekly_avg': round(weekly_avg, 2),
-            'last_refill': last_refill,
-            'last_update': last_update
-        })
+        return with_etag(jsonify(daily_stats_payload(utc_start_of_day, device_id)), etag)
 
     except Exception as e:
         logger.error(f"Error fetching daily stats: {e}")
@@ -576,13 +2415,15 @@ def handle_config():
     if request.method == 'GET':
         try:
             last_config_fetch = datetime.now(pytz.UTC)
-            with open(CONFIG_FILE_PATH, 'r') as f:
-                config = json.load(f)
-            return jsonify({
+            config, _, etag = config_store.get()
+            cached = not_modified(etag)
+            if cached:
+                return cached
+            return with_etag(jsonify({
                 'wifi_ssid': config['wifi_ssid'],
                 'wifi_password': config['wifi_password'],
                 'fast_data': config.get('fast_data', False)
-            })
+            }), etag)
         except Exception as e:
             logger.error(f"Error reading config file: {e}")
             return jsonify({'error': 'Failed to read config file'}), 500
@@ -599,14 +2440,71 @@ def handle_config():
                 'fast_data': config_data.get('fast_data', False)
             }
             
-            with open(CONFIG_FILE_PATH, 'w') as f:
-                json.dump(config, f)
+            config_store.save(config)
             
             return jsonify({'success': True, 'message': 'Configuration saved'})
         except Exception as e:
             logger.error(f"Error saving config: {e}")
             return jsonify({'error': 'Failed to save config'}), 500
 
+# Manifest of the current firmware.bin, cached per (inode, mtime, size)
+firmware_manifest_cache = {'signature': None, 'manifest': None}
+firmware_manifest_lock = threading.Lock()
+
+def firmware_signature():
+    st = os.stat(FIRMWARE_PATH)
+    return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+def build_firmware_manifest(version=None):
+    """Hash firmware.bin once and store its manifest next to it"""
+    sha256 = hashlib.sha256()
+    with open(FIRMWARE_PATH, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    signature = firmware_signature()
+
+    manifest = {
+        'filename': 'firmware.bin',
+        'size': signature[2],
+        'sha256': digest,
+        'version': version or digest[:12],
+        'uploaded_at': datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S'),
+        'signature': signature
+    }
+    tmp_path = f"{FIRMWARE_MANIFEST_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, FIRMWARE_MANIFEST_PATH)
+    return manifest
+
+def get_firmware_manifest():
+    """Return the current firmware manifest, or None if there is no firmware.
+
+    Costs one stat() per call; the file is only re-hashed if firmware.bin was
+    replaced without going through the upload endpoint.
+    """
+    try:
+        signature = firmware_signature()
+    except FileNotFoundError:
+        return None
+
+    with firmware_manifest_lock:
+        if firmware_manifest_cache['signature'] == signature:
+            return firmware_manifest_cache['manifest']
+
+        manifest = None
+        try:
+            with open(FIRMWARE_MANIFEST_PATH) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if not manifest or manifest.get('signature') != signature:
+            manifest = build_firmware_manifest()
+
+        firmware_manifest_cache.update(signature=signature, manifest=manifest)
+        return manifest
+
 # Replace firmware handlers
 @app.route('/api/firmware', methods=['GET', 'POST'])
 def handle_firmware():
@@ -614,12 +2512,19 @@ def handle_firmware():
     
     if request.method == 'GET':
         try:
-            firmware_path = os.path.join(FIRMWARE_DIR, 'firmware.bin')
-            if not os.path.exists(firmware_path):
+            manifest = get_firmware_manifest()
+            if not manifest:
                 return jsonify({'error': 'No firmware found'}), 404
             
             last_firmware_fetch = datetime.now(pytz.UTC)
-            return send_from_directory(FIRMWARE_DIR, 'firmware.bin')
+            # Conditional send: If-None-Match gives 304, Range gives 206
+            response = send_from_directory(
+                FIRMWARE_DIR, 'firmware.bin',
+                etag=manifest['sha256'], conditional=True
+            )
+            response.headers['Accept-Ranges'] = 'bytes'
+            response.headers['X-Firmware-Version'] = manifest['version']
+            return response
         except Exception as e:
             logger.error(f"Error serving firmware: {e}")
             return jsonify({'error': str(e)}), 500
@@ -633,21 +2538,48 @@ def handle_firmware():
             if file.filename == '' or not file.filename.endswith('.bin'):
                 return jsonify({'error': 'Invalid firmware file'}), 400
             
-            firmware_path = os.path.join(FIRMWARE_DIR, 'firmware.bin')
-            if os.path.exists(firmware_path):
-                os.remove(firmware_path)
-            
-            file.save(firmware_path)
+            # Rename into place so in-flight downloads keep reading the old file
+            tmp_path = f"{FIRMWARE_PATH}.{os.getpid()}.tmp"
+            file.save(tmp_path)
+            os.replace(tmp_path, FIRMWARE_PATH)
+
+            with firmware_manifest_lock:
+                manifest = build_firmware_manifest(request.form.get('version'))
+                firmware_manifest_cache.update(signature=manifest['signature'], manifest=manifest)
             
             return jsonify({
                 'success': True,
                 'message': 'Firmware uploaded successfully',
-                'size': os.path.getsize(firmware_path)
+                'size': manifest['size'],
+                'sha256': manifest['sha256'],
+                'version': manifest['version']
             })
         except Exception as e:
             logger.error(f"Error uploading firmware: {e}")
             return jsonify({'error': str(e)}), 500
 
+@app.route('/api/firmware/manifest')
+def get_firmware_manifest_route():
+    """Size, SHA-256 and version of the current firmware"""
+    try:
+        manifest = get_firmware_manifest()
+        if not manifest:
+            return jsonify({'error': 'No firmware found'}), 404
+
+        cached = not_modified(manifest['sha256'])
+        if cached:
+            return cached
+        return with_etag(jsonify({
+            'filename': manifest['filename'],
+            'size': manifest['size'],
+            'sha256': manifest['sha256'],
+            'version': manifest['version'],
+            'uploaded_at': manifest['uploaded_at']
+        }), manifest['sha256'])
+    except Exception as e:
+        logger.error(f"Error reading firmware manifest: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # Add new endpoint to get fetch timestamps
 @app.route('/api/fetch-status')
 def get_fetch_status():
@@ -677,8 +2609,7 @@ def verify_config():
         if not config_data:
             return jsonify({'error': 'Configuration data is required'}), 400
 
-        with open(CONFIG_FILE_PATH, 'r') as f:
-            current_config = json.load(f)
+        current_config, _, _ = config_store.get()
 
         if current_config != config_data:
             return jsonify({'error': 'Configuration verification failed'}), 400
@@ -709,10 +2640,11 @@ def firmware_page():
 def get_current_config():
     """Return config in the same format as local server"""
     try:
-        with open(CONFIG_FILE_PATH, 'r') as f:
-            config = json.load(f)
-            response = f"{1 if config.get('fast_data', False) else 0}\n{config.get('wifi_ssid', '')}\n{config.get('wifi_password', '')}"
-            return response, 200, {'Content-Type': 'text/plain'}
+        _, current_text, etag = config_store.get()
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        return with_etag(app.response_class(current_text, headers={'Content-Type': 'text/plain'}), etag)
     except Exception as e:
         logger.error(f"Error reading config: {e}")
         return "0\n\n", 500
@@ -725,11 +2657,14 @@ def get_firmware_status():
         if os.path.exists(firmware_path):
             size = os.path.getsize(firmware_path)
             modified = datetime.fromtimestamp(os.path.getmtime(firmware_path))
+            manifest = get_firmware_manifest()
             return jsonify({
                 'exists': True,
                 'size': size,
                 'last_modified': modified.strftime('%Y-%m-%d %H:%M:%S'),
-                'filename': 'firmware.bin'
+                'filename': 'firmware.bin',
+                'sha256': manifest['sha256'],
+                'version': manifest['version']
             })
         return jsonify({'exists': False})
     except Exception as e:
@@ -743,6 +2678,8 @@ def remove_firmware():
         firmware_path = os.path.join(FIRMWARE_DIR, 'firmware.bin')
         if os.path.exists(firmware_path):
             os.remove(firmware_path)
+            if os.path.exists(FIRMWARE_MANIFEST_PATH):
+                os.remove(FIRMWARE_MANIFEST_PATH)
             return jsonify({'success': True, 'message': 'Firmware removed'})
         return jsonify({'error': 'No firmware found'}), 404
     except Exception as e:
@@ -750,26 +2687,75 @@ def remove_firmware():
         return jsonify({'error': str(e)}), 500
 
 # Create database tables
+def setup_database():
+    """Create the tables, migrate older databases and add the default device and settings.
+
+    Every process runs this at import; once done it only takes a few quick
+    queries. gunicorn.conf.py runs it once before the workers start, so a long
+    migration doesn't happen inside a worker.
+    """
+    with schema_lock() as conn:
+        db.metadata.create_all(conn)
+    migrate_device_columns()
+    migrate_timestamps_to_epoch()
+    db.session.execute(sqlite_insert(Device).values(
+        id=DEFAULT_DEVICE_ID,
+        name='Main tank',
+        min_distance=MIN_DISTANCE,
+        max_distance=MAX_DISTANCE,
+        liters_per_cm=LITERS_PER_CM
+    ).on_conflict_do_nothing())
+    db.session.commit()
+    settings = Settings.query.filter_by(user_id=USER_LOGIN).first()
+    if not settings:
+        settings = Settings(
+            user_id=USER_LOGIN,
+            critical_threshold=20,
+            warning_threshold=40,
+            theme='light',
+            show_weather=True,
+            show_predictions=True,
+            last_update=INITIAL_DATE
+        )
+        db.session.add(settings)
+        db.session.commit()
+
 with app.app_context():
     try:
-        db.create_all()
-        settings = Settings.query.filter_by(user_id=USER_LOGIN).first()
-        if not settings:
-            settings = Settings(
-                user_id=USER_LOGIN,
-                critical_threshold=20,
-                warning_threshold=40,
-                theme='light',
-                show_weather=True,
-                show_predictions=True,
-                last_update=INITIAL_DATE
-            )
-            db.session.add(settings)
-            db.session.commit()
+        setup_database()
+        sync_recent_readings()  # Seed the ring buffer from the database
+        last_streamed_id = recent_synced_id
+        if INGEST_MODE == 'queued':
+            start_ingest_writer()
+        start_retention_worker()
         logger.info("Database tables and default settings created successfully")
     except Exception as e:
         logger.error(f"Error creating database tables: {e}")
         raise
 
+@app.cli.command('setup-db')
+def setup_db_command():
+    """Create or migrate the database schema; gunicorn.conf.py runs this before starting workers"""
+    # Importing the app has already done the work, see setup_database()
+    logger.info("Database is ready")
+
+@app.cli.command('backfill-rollups')
+def backfill_rollups_command():
+    """Rebuild the hourly/daily usage rollups from existing readings"""
+    readings, rollups = backfill_rollups()
+    logger.info(f"Backfilled {rollups} rollups from {readings} readings")
+
+@app.cli.command('backfill-events')
+def backfill_events_command():
+    """Rebuild the usage/refill events from existing readings"""
+    readings, events = backfill_events()
+    logger.info(f"Detected {events} events in {readings} readings")
+
+@app.cli.command('compact')
+def compact_command():
+    """Apply the retention policy now"""
+    readings, minutes = run_retention()
+    logger.info(f"Compacted {readings} readings and {minutes} minute aggregates")
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
@@ -0,0 +1,255 @@
+"""Micro-benchmarks for the request hot paths.
+
+Builds databases of several sizes with init_db's sample generator, then
+times the code that runs on every dashboard poll and device update:
+WaterLevel.to_dict(), calculate_data_checksum(), /api/data,
+/api/stats/weekly, /api/stats/daily and POST /update. It also times
+analytics.usage_by_period over the newest (up to) ANALYTICS_ROWS readings,
+the work `flask backfill-rollups` does per device. The routes are timed
+through the Flask test client, so routing, serialization and the SQLite
+queries are included but the network is not.
+
+Each size runs in its own process, because app.py binds to
+./data/water_levels.db when it is imported.
+
+    python benchmark.py --sizes 10000,1000000 --output bench.json
+    python benchmark.py --sizes 10000,1000000 --compare bench.json --threshold 0.2
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pytz
+
+import analytics
+import init_db
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = '10000,1000000,10000000'
+SERIALIZE_BATCH = 1000  # Readings per to_dict()/checksum timing
+ANALYTICS_ROWS = 1000000  # Readings per usage_by_period timing
+
+logger = logging.getLogger(__name__)
+
+
+def build_database(path, rows, interval):
+    """Fill a fresh database with `rows` readings, `interval` seconds apart, ending now"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    start_epoch = int(time.time()) - (rows - 1) * interval
+
+    conn = sqlite3.connect(path)
+    try:
+        cursor = conn.cursor()
+        init_db.create_tables(cursor)
+        init_db.insert_default_settings(cursor)
+        init_db.insert_devices(cursor, [init_db.DEVICE_ID.format(1)])
+        init_db.generate_sample_data(cursor, start_epoch, rows, interval)
+        init_db.create_indexes(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def summarize_timings(samples):
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'min_ms': round(samples[0] * 1000, 4),
+        'median_ms': round(statistics.median(samples) * 1000, 4),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 4),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 4),
+    }
+
+
+def time_call(fn, repeat):
+    """Run `fn` once to warm up, then `repeat` timed runs with the garbage collector paused (as timeit does)"""
+    fn()
+    samples = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - started)
+    finally:
+        gc.enable()
+    return summarize_timings(samples)
+
+
+def run_size(rows, repeat):
+    """Time every target against ./data/water_levels.db (runs in the worker process)"""
+    sys.path.insert(0, REPO_DIR)
+    os.environ.setdefault('RETENTION_INTERVAL', '0')  # Keep the timed data in the raw tier
+    import app as water_app
+
+    client = water_app.app.test_client()
+
+    def request(method, url, **kwargs):
+        response = client.open(url, method=method, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {url} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+        return response
+
+    with water_app.app.app_context():
+        if water_app.UsageRollup.query.first() is None:
+            started = time.perf_counter()
+            water_app.backfill_rollups()
+            logger.info(f"Backfilled rollups for {rows} rows in {time.perf_counter() - started:.1f}s")
+
+        readings = (
+            water_app.WaterLevel.query.order_by(water_app.WaterLevel.timestamp.desc()).limit(SERIALIZE_BATCH).all()
+        )
+        dicts = [reading.to_dict() for reading in readings]
+
+        # The arrays backfill_device_rollups() builds, pulled outside the timing
+        newest = water_app.db.session.execute(
+            water_app.db.select(
+                water_app.db.type_coerce(water_app.WaterLevel.timestamp, water_app.db.Integer),
+                water_app.WaterLevel.water_level
+            ).order_by(water_app.WaterLevel.timestamp.desc()).limit(ANALYTICS_ROWS)
+        ).all()[::-1]
+        epochs = analytics.from_epoch_seconds([epoch for epoch, _ in newest])
+        levels = np.array([level for _, level in newest], dtype=float)
+        tz = pytz.timezone('Asia/Kolkata')
+
+        results = {
+            'to_dict': time_call(lambda: [reading.to_dict() for reading in readings], repeat),
+            'calculate_data_checksum': time_call(lambda: water_app.calculate_data_checksum(dicts), repeat),
+            'usage_by_period': time_call(
+                lambda: analytics.usage_by_period(epochs, levels, tz, water_app.LITERS_PER_CM, water_app.REFILL_THRESHOLD),
+                repeat
+            ),
+        }
+
+    results['get_data'] = time_call(lambda: request('GET', '/api/data?hours=24'), repeat)
+    results['get_weekly_stats'] = time_call(lambda: request('GET', '/api/stats/weekly'), repeat)
+    results['get_daily_stats'] = time_call(lambda: request('GET', '/api/stats/daily'), repeat)
+    results['update_water_level'] = time_call(
+        lambda: request('POST', '/update', json={'distance': round(random.uniform(init_db.MIN_DISTANCE, init_db.MAX_DISTANCE), 2)}),
+        repeat
+    )
+    return results
+
+
+def run_worker(rows, workdir, repeat, interval, reuse):
+    """Build (or reuse) the database for one size and benchmark it in a child process"""
+    size_dir = os.path.join(workdir, str(rows))
+    db_file = os.path.join(size_dir, init_db.DATABASE_PATH)
+    if not (reuse and os.path.exists(db_file)):
+        started = time.perf_counter()
+        build_database(db_file, rows, interval)
+        logger.info(f"Built {rows}-row database in {time.perf_counter() - started:.1f}s")
+
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', str(rows), '--repeat', str(repeat)],
+        cwd=size_dir, stdout=subprocess.PIPE, check=True
+    )
+    return json.loads(result.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline, threshold, metric):
+    """Print the changes in `metric` against a baseline run; return the regressions"""
+    regressions = []
+    print(f"{'rows':>10}  {'target':<24} {'baseline ms':>12} {'current ms':>12} {'change':>8}  ({metric})")
+    for size, targets in current['results'].items():
+        for target, timing in targets.items():
+            before = baseline.get('results', {}).get(size, {}).get(target)
+            if not before:
+                continue
+            change = timing[metric] / before[metric] - 1 if before[metric] else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append((size, target, change))
+            print(f"{size:>10}  {target:<24} {before[metric]:>12.3f} {timing[metric]:>12.3f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Water Monitor request hot paths')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f'comma-separated row counts (default {DEFAULT_SIZES})')
+    parser.add_argument('--repeat', type=int, default=20, help='timed runs per target (default 20)')
+    parser.add_argument('--interval', type=int, default=60, help='seconds between generated readings (default 60)')
+    parser.add_argument('--workdir', default='benchmark_data', help='where the databases are built (default benchmark_data)')
+    parser.add_argument('--reuse', action='store_true', help='reuse databases left in --workdir by an earlier run')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare against an earlier results file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown flagged as a regression (default 0.2 = 20%%)')
+    parser.add_argument('--metric', choices=('min_ms', 'median_ms', 'p95_ms', 'mean_ms'), default='min_ms',
+                        help='statistic compared against the baseline (default min_ms, the least noisy)')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # Logs through app's QueueHandler, which only installs itself if nothing configured logging first
+        print(json.dumps(run_size(args.worker, args.repeat)))
+        return 0
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    workdir = os.path.abspath(args.workdir)
+    report = {
+        'meta': {
+            'created': datetime.now(pytz.UTC).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(),
+            'repeat': args.repeat,
+            'interval': args.interval,
+            'serialize_batch': SERIALIZE_BATCH,
+        },
+        'results': {},
+    }
+    for rows in sizes:
+        report['results'][str(rows)] = run_worker(rows, workdir, args.repeat, args.interval, args.reuse)
+        for target, timing in report['results'][str(rows)].items():
+            logger.info(f"{rows:>10} rows  {target:<24} median {timing['median_ms']:.3f} ms  p95 {timing['p95_ms']:.3f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold, args.metric)
+        if regressions:
+            logger.error(f"{len(regressions)} target(s) slower than the baseline by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""In-memory cache of the device configuration file.
+
+Devices poll the configuration constantly. The parsed JSON, the plain-text
+body served by /api/config/current and an ETag are kept in memory. The file
+is only revalidated by stat() (mtime, size and inode), at most once every
+`check_interval` seconds, so a steady-state poll does no file I/O. Writes go
+to a temporary file that is renamed over the original. Other workers see the
+new inode on their next revalidation and never read a half-written file.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class ConfigStore:
+    def __init__(self, path, default, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.signature = None
+        self.checked_at = 0.0
+        self.snapshot = None  # (config, plain-text body, etag), swapped as one object
+
+        if not os.path.exists(path):
+            self.save(default)
+
+    def get(self):
+        """Return (config dict, plain-text body, etag), reloading only if the file changed"""
+        now = time.monotonic()
+        if self.snapshot is None or now - self.checked_at >= self.check_interval:
+            with self.lock:
+                self._revalidate()
+                self.checked_at = now
+        return self.snapshot
+
+    def save(self, config):
+        """Atomically replace the config file and the cached copy"""
+        raw = json.dumps(config).encode('utf-8')
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        with self.lock:
+            self._load(raw, self._stat_signature())
+            self.checked_at = time.monotonic()
+
+    def _stat_signature(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _revalidate(self):
+        signature = self._stat_signature()
+        if signature != self.signature:
+            with open(self.path, 'rb') as f:
+                self._load(f.read(), signature)
+
+    def _load(self, raw, signature):
+        config = json.loads(raw)
+        current_text = (
+            f"{1 if config.get('fast_data', False) else 0}\n"
+            f"{config.get('wifi_ssid', '')}\n"
+            f"{config.get('wifi_password', '')}"
+        )
+        self.snapshot = (config, current_text, hashlib.sha1(raw).hexdigest())
+        self.signature = signature
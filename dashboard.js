@@ -1,7 +1,10 @@
 // Global Variables
 const USER_LOGIN = 'Ashiboy04';
 const UPDATE_INTERVAL = 5000; // 5 seconds
+const SLOW_UPDATE_INTERVAL = 60000; // Weather and weekly stats while the live stream is connected
+const MAX_CHART_POINTS = 1000; // Server-side downsampling limit for the historical chart
 const INITIAL_DATE = '2025-01-25 05:27:37'; // Starting UTC time
+const DEVICE_ID = new URLSearchParams(window.location.search).get('device'); // Tank shown, ?device=tank-2 (server default if absent)
 
 const CHART_COLORS = {
     blue: 'rgba(0, 123, 255, 0.5)',
@@ -15,6 +18,9 @@ let lastUpdate = new Date(INITIAL_DATE);
 let chartUpdateTimer = null;
 let lastDataUpdate = new Date();
 let selectedTimeRange = 24; // Default 24 hours
+let historicalCursor = null; // Last reading id held by the historical chart
+let etags = {}; // Last ETag seen per polled URL
+let eventSource = null; // Live stream of readings and daily counters
 let alertHistory = new Set(); // Store alert hashes to prevent duplicates
 
 // Utility Functions
@@ -36,17 +42,37 @@ function updateClock() {
 }
 
 // API Functions
+
+// Add the selected tank to an API URL
+function withDevice(url) {
+    if (!DEVICE_ID) return url;
+    return `${url}${url.includes('?') ? '&' : '?'}device=${encodeURIComponent(DEVICE_ID)}`;
+}
+
+// GET `url`, sending the last ETag seen for it. Resolves to null when the
+// server answers 304 Not Modified, i.e. nothing changed since the last poll.
+async function fetchIfChanged(url) {
+    const headers = {};
+    if (etags[url]) headers['If-None-Match'] = etags[url];
+
+    const response = await fetch(url, { headers });
+    if (response.status === 304) return null;
+    if (!response.ok) throw new Error(response.statusText);
+
+    const etag = response.headers.get('ETag');
+    if (etag) etags[url] = etag;
+    return await response.json();
+}
+
 async function fetchWaterLevel() {
     try {
-        const response = await fetch('/api/data?hours=24');
+        const response = await fetch(withDevice('/api/latest'));
         if (!response.ok) throw new Error(`Failed to fetch water level data: ${response.statusText}`);
         const data = await response.json();
-        console.log('Fetched water level data:', data);
         
-        if (data.success && data.data && data.data.length > 0) {
-            const latestReading = data.data[data.data.length - 1];
-            console.log('Latest reading:', latestReading);
-            return latestReading;
+        if (data.success && data.data) {
+            console.log('Latest reading:', data.data);
+            return data.data;
         }
         console.warn('No water level data available');
         return null;
@@ -96,11 +122,47 @@ function displayWeatherError(message) {
     `;
 }
 
-async function fetchHistoricalData(hours = selectedTimeRange) {
+// Chart points from a format=binary response: X-Count float32 time offsets
+// (seconds after X-Base-Timestamp) followed by X-Count float32 water levels
+function parseBinaryHistory(buffer, headers) {
+    const count = parseInt(headers.get('X-Count')) || 0;
+    const base = parseFloat(headers.get('X-Base-Timestamp')) || 0;
+    const offsets = new Float32Array(buffer, 0, count);
+    const levels = new Float32Array(buffer, count * 4, count);
+    const nextSinceId = headers.get('X-Next-Since-Id');
+
+    return {
+        points: Array.from(offsets, (offset, i) => ({
+            x: new Date((base + offset) * 1000),
+            y: levels[i]
+        })),
+        nextSinceId: nextSinceId ? parseInt(nextSinceId) : null
+    };
+}
+
+// Chart points from a format=columnar response (delta-encoded timestamps)
+function parseColumnarHistory(data) {
+    let timestamp = 0;
+    return {
+        points: data.timestamp.map((delta, i) => {
+            timestamp += delta;
+            return { x: new Date(timestamp * 1000), y: data.water_level[i] / data.scale };
+        }),
+        nextSinceId: data.next_since_id ?? null
+    };
+}
+
+async function fetchHistoricalData(hours = selectedTimeRange, sinceId = null) {
     try {
-        const response = await fetch(`/api/data?hours=${hours}`);
-        if (!response.ok) throw new Error(`Failed to fetch historical data: ${response.statusText}`);
-        return await response.json();
+        const url = withDevice(`/api/data?hours=${hours}&max_points=${MAX_CHART_POINTS}`);
+        if (sinceId === null) {
+            // Full reload: always take the body, the chart was reset
+            const response = await fetch(`${url}&format=binary`);
+            if (!response.ok) throw new Error(`Failed to fetch historical data: ${response.statusText}`);
+            return parseBinaryHistory(await response.arrayBuffer(), response.headers);
+        }
+        const data = await fetchIfChanged(`${url}&format=columnar&since_id=${sinceId}`);
+        return data ? parseColumnarHistory(data) : null;
     } catch (error) {
         console.error('Error fetching historical data:', error);
         showAlert('error', `Failed to fetch historical data: ${error.message}`);
@@ -110,9 +172,7 @@ async function fetchHistoricalData(hours = selectedTimeRange) {
 
 async function fetchWeeklyStats() {
     try {
-        const response = await fetch('/api/stats/weekly');
-        if (!response.ok) throw new Error(`Failed to fetch weekly stats: ${response.statusText}`);
-        return await response.json();
+        return await fetchIfChanged(withDevice('/api/stats/weekly'));
     } catch (error) {
         console.error('Error fetching weekly stats:', error);
         showAlert('error', `Failed to fetch weekly statistics: ${error.message}`);
@@ -169,6 +229,7 @@ function clearDashboardData() {
         charts.historical.data.datasets[0].data = [];
         charts.historical.update();
     }
+    historicalCursor = null;
 }
 
 function clearLogs() {
@@ -463,20 +524,42 @@ function initializeCharts() {
     });
 }
 
-function updateHistoricalChart(data) {
-    if (!data?.data || !charts.historical) return;
+function updateHistoricalChart(points, append = false) {
+    if (!points || !charts.historical) return;
+
+    let chartData = points;
+
+    if (append) {
+        if (chartData.length === 0) return;
+        chartData = charts.historical.data.datasets[0].data.concat(chartData);
+    }
+
+    chartData.sort((a, b) => a.x - b.x);
 
-    const chartData = data.data
-        .map(item => ({
-            x: new Date(item.timestamp),
-            y: parseFloat(item.water_level)
-        }))
-        .sort((a, b) => a.x - b.x);
+    if (append) {
+        // Drop points that slid out of the selected window
+        const cutoff = chartData[chartData.length - 1].x - selectedTimeRange * 3600 * 1000;
+        chartData = chartData.filter(point => point.x >= cutoff);
+    }
 
     charts.historical.data.datasets[0].data = chartData;
     charts.historical.update('none');
 }
 
+async function refreshHistoricalChart(reset = false) {
+    if (reset) historicalCursor = null;
+
+    const hours = selectedTimeRange;
+    const sinceId = historicalCursor;
+    const history = await fetchHistoricalData(hours, sinceId);
+
+    // Ignore responses for a time range the user has since switched away from
+    if (!history || hours !== selectedTimeRange || sinceId !== historicalCursor) return;
+
+    updateHistoricalChart(history.points, sinceId !== null);
+    historicalCursor = history.nextSinceId;
+}
+
 function showAlert(type, message) {
     const alertHash = `${type}-${message}`;
     if (alertHistory.has(alertHash)) return;
@@ -657,11 +740,10 @@ function initializeThemeToggle() {
 
 async function updateDashboard() {
     try {
-        const [waterData, weatherData, historicalData, weeklyData] = await Promise.all([
+        const [waterData] = await Promise.all([
             fetchWaterLevel(),
-            fetchWeatherData(),
-            fetchHistoricalData(selectedTimeRange),
-            fetchWeeklyStats()
+            refreshHistoricalChart(),
+            updateSlowPanels()
         ]);
 
         if (waterData) {
@@ -669,23 +751,6 @@ async function updateDashboard() {
             lastDataUpdate = new Date();
         }
 
-        if (weatherData) {
-            console.log('Weather data received:', weatherData);
-            updateWeatherDisplay(weatherData);
-        }
-
-        if (historicalData?.data) {
-            updateHistoricalChart(historicalData);
-        }
-
-        if (weeklyData?.data) {
-            const totalUsage = weeklyData.data.reduce((a, b) => a + b.consumption, 0);
-            const avgDaily = totalUsage / (weeklyData.data.length || 1);
-            document.getElementById('totalWeeklyUsage').textContent = `${totalUsage.toFixed(1)} L`;
-            document.getElementById('avgDailyUsage').textContent = `${avgDaily.toFixed(1)} L`;
-            document.getElementById('peakUsageDay').textContent = weeklyData.data.reduce((a, b) => a.consumption > b.consumption ? a : b, { date: 'No data' }).date;
-        }
-
         await updateQuickStats();
 
     } catch (error) {
@@ -694,38 +759,104 @@ async function updateDashboard() {
     }
 }
 
+// Panels that are not pushed over the live stream
+async function updateSlowPanels() {
+    const [weatherData, weeklyData] = await Promise.all([
+        fetchWeatherData(),
+        fetchWeeklyStats()
+    ]);
+
+    if (weatherData) {
+        console.log('Weather data received:', weatherData);
+        updateWeatherDisplay(weatherData);
+    }
+
+    if (weeklyData?.data) {
+        const totalUsage = weeklyData.data.reduce((a, b) => a + b.consumption, 0);
+        const avgDaily = totalUsage / (weeklyData.data.length || 1);
+        document.getElementById('totalWeeklyUsage').textContent = `${totalUsage.toFixed(1)} L`;
+        document.getElementById('avgDailyUsage').textContent = `${avgDaily.toFixed(1)} L`;
+        document.getElementById('peakUsageDay').textContent = weeklyData.data.reduce((a, b) => a.consumption > b.consumption ? a : b, { date: 'No data' }).date;
+    }
+}
+
+function setUpdateTimer(update, interval) {
+    if (chartUpdateTimer) clearInterval(chartUpdateTimer);
+    chartUpdateTimer = setInterval(update, interval);
+}
+
+// Readings and daily counters are pushed over /api/stream while it is open.
+// Until it opens, and whenever it drops, the dashboard polls everything.
+function connectLiveStream() {
+    if (!window.EventSource) return;
+
+    const resumeFrom = historicalCursor !== null ? `?last_event_id=${historicalCursor}` : '';
+    eventSource = new EventSource(withDevice(`/api/stream${resumeFrom}`));
+
+    eventSource.addEventListener('open', () => {
+        setUpdateTimer(updateSlowPanels, SLOW_UPDATE_INTERVAL);
+    });
+
+    eventSource.addEventListener('error', () => {
+        // The browser reconnects by itself, sending Last-Event-ID
+        setUpdateTimer(updateDashboard, UPDATE_INTERVAL);
+    });
+
+    eventSource.addEventListener('reading', (e) => {
+        const reading = JSON.parse(e.data);
+        updateWaterLevel(reading);
+        lastDataUpdate = new Date();
+
+        if (historicalCursor !== null && reading.id > historicalCursor) {
+            // Timestamps are IST wall-clock strings
+            const x = new Date(`${reading.timestamp.replace(' ', 'T')}+05:30`);
+            updateHistoricalChart([{ x, y: reading.water_level }], true);
+            historicalCursor = reading.id;
+        }
+    });
+
+    eventSource.addEventListener('stats', (e) => applyQuickStats(JSON.parse(e.data)));
+
+    // Missed more readings than the server buffers: reload everything
+    eventSource.addEventListener('resync', () => {
+        refreshHistoricalChart(true);
+        updateDashboard();
+    });
+}
+
 async function updateQuickStats() {
     try {
-        const response = await fetch('/api/stats/daily');
-        const data = await response.json();
+        applyQuickStats(await fetchIfChanged(withDevice('/api/stats/daily')));
+    } catch (error) {
+        console.error('Error updating quick stats:', error);
+    }
+}
+
+function applyQuickStats(data) {
+    if (data?.success) {
+        const dailyUsage = document.getElementById('dailyUsage');
+        const weeklyAvg = document.getElementById('weeklyAvg');
+        const lastRefill = document.getElementById('lastRefill');
         
-        if (data.success) {
-            const dailyUsage = document.getElementById('dailyUsage');
-            const weeklyAvg = document.getElementById('weeklyAvg');
-            const lastRefill = document.getElementById('lastRefill');
-            
-            if (dailyUsage) animateValue(dailyUsage, parseFloat(dailyUsage.textContent) || 0, data.daily_usage, 1000, ' L');
-            if (weeklyAvg) animateValue(weeklyAvg, parseFloat(weeklyAvg.textContent) || 0, data.weekly_avg, 1000, ' L');
+        if (dailyUsage) animateValue(dailyUsage, parseFloat(dailyUsage.textContent) || 0, data.daily_usage, 1000, ' L');
+        if (weeklyAvg) animateValue(weeklyAvg, parseFloat(weeklyAvg.textContent) || 0, data.weekly_avg, 1000, ' L');
+        
+        if (lastRefill && data.last_refill !== lastRefill.textContent) {
+            lastRefill.textContent = data.last_refill;
+            lastRefill.classList.add('highlight');
+            setTimeout(() => lastRefill.classList.remove('highlight'), 2000);
             
-            if (lastRefill && data.last_refill !== lastRefill.textContent) {
-                lastRefill.textContent = data.last_refill;
-                lastRefill.classList.add('highlight');
-                setTimeout(() => lastRefill.classList.remove('highlight'), 2000);
-                
-                if (data.last_refill !== "No refill") {
-                    showAlert('success', `Tank refilled at ${data.last_refill}`);
-                }
+            if (data.last_refill !== "No refill") {
+                showAlert('success', `Tank refilled at ${data.last_refill}`);
             }
+        }
 
-            const lastUpdate = document.getElementById('lastUpdate');
-            if (lastUpdate && data.last_update !== lastUpdate.textContent) {
-                lastUpdate.textContent = data.last_update;
-                lastUpdate.classList.add('highlight');
-                setTimeout(() => lastUpdate.classList.remove('highlight'), 2000);
-            }
+        const lastUpdate = document.getElementById('lastUpdate');
+        if (lastUpdate && data.last_update !== lastUpdate.textContent) {
+            lastUpdate.textContent = data.last_update;
+            lastUpdate.classList.add('highlight');
+            setTimeout(() => lastUpdate.classList.remove('highlight'), 2000);
         }
-    } catch (error) {
-        console.error('Error updating quick stats:', error);
     }
 }
 
@@ -766,18 +897,20 @@ document.addEventListener('DOMContentLoaded', async () => {
         initializeAlerts();
         
         await updateDashboard();
-        if (chartUpdateTimer) clearInterval(chartUpdateTimer);
-        chartUpdateTimer = setInterval(updateDashboard, UPDATE_INTERVAL);
+        setUpdateTimer(updateDashboard, UPDATE_INTERVAL);
+        connectLiveStream();
         setInterval(updateClock, 1000);
         
         const timeRange = document.getElementById('timeRange');
         if (timeRange) {
             timeRange.addEventListener('change', async () => {
                 selectedTimeRange = parseInt(timeRange.value);
-                const data = await fetchHistoricalData(selectedTimeRange);
-                if (data) updateHistoricalChart(data);
+                await refreshHistoricalChart(true);
             });
-            selectedTimeRange = parseInt(timeRange.value);
+            if (parseInt(timeRange.value) !== selectedTimeRange) {
+                selectedTimeRange = parseInt(timeRange.value);
+                await refreshHistoricalChart(true);
+            }
         }
 
         if ('ontouchstart' in window) {
@@ -0,0 +1,109 @@
+"""Fan-out of live events to Server-Sent Events clients.
+
+Each gunicorn worker keeps its own subscribers. The worker that stores a
+reading publishes it to them straight away and calls notify(), which swaps
+a small notification file. Workers with subscribers watch that file with
+stat() (like ConfigStore) and call `on_change` when it changes, so they can
+pull what the other workers wrote. No broker is involved. An idle stream
+costs one stat() per poll interval and no queries. A worker without
+subscribers does not even do that.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EventBroadcaster:
+    def __init__(self, notify_path, on_change, poll_interval=0.25, backlog=256):
+        self.notify_path = notify_path
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.backlog = backlog  # Events queued per client before it is dropped
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.watcher = None
+
+        if not os.path.exists(notify_path):
+            self.notify()
+        self.signature = self._stat_signature()
+
+    def subscriber_count(self):
+        return len(self.subscribers)
+
+    def subscribe(self):
+        """Return a queue receiving (event, id, data) tuples, or None once dropped"""
+        subscription = queue.Queue(maxsize=self.backlog)
+        with self.lock:
+            self.subscribers.add(subscription)
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self._watch, name='event-watcher', daemon=True)
+                self.watcher.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def close(self):
+        """End every open stream, so a stopping worker doesn't wait on them"""
+        with self.lock:
+            subscribers = list(self.subscribers)
+            self.subscribers.clear()
+        for subscription in subscribers:
+            self._close(subscription)
+
+    def publish(self, event, event_id, data):
+        """Queue an event for every local subscriber"""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait((event, event_id, data))
+            except queue.Full:
+                # Slow client: cut it off, it resumes from Last-Event-ID when it reconnects
+                self.unsubscribe(subscription)
+                self._close(subscription)
+
+    def notify(self):
+        """Tell the other workers there is something new"""
+        tmp_path = f"{self.notify_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(f"{os.getpid()} {time.time_ns()}")
+            os.replace(tmp_path, self.notify_path)  # New inode every time, even within one mtime tick
+        except OSError as e:
+            logger.warning(f"Could not write stream notification file: {e}")
+
+    @staticmethod
+    def _close(subscription):
+        while True:
+            try:
+                subscription.get_nowait()
+            except queue.Empty:
+                break
+        subscription.put_nowait(None)
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.notify_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            if not self.subscribers:
+                continue
+            signature = self._stat_signature()
+            if signature == self.signature:
+                continue
+            self.signature = signature
+            try:
+                self.on_change()
+            except Exception as e:
+                logger.error(f"Error pulling stream events: {e}")
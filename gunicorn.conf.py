@@ -0,0 +1,50 @@
+"""Gunicorn settings: gunicorn -c gunicorn.conf.py app:app
+
+Creates or migrates the database once before the workers start (see
+setup_database() in app.py), so a long migration on an old database doesn't
+run inside the workers and hold them past their lock and boot timeouts.
+
+Ends the workers' open /api/stream responses on SIGTERM. Otherwise every
+stop or reload with a dashboard open waits out the graceful timeout.
+
+Sets up the shared directory the workers write their Prometheus metrics to
+(see metrics.py). It is emptied when gunicorn starts, and a worker's files
+are released when the worker exits.
+"""
+import os
+import shutil
+import signal
+import subprocess
+import sys
+
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(os.getcwd(), 'data', 'metrics'))
+
+
+def on_starting(server):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path),
+               RETENTION_INTERVAL='0', INGEST_MODE='direct')
+    env.pop('PROMETHEUS_MULTIPROC_DIR')
+    server.log.info("Setting up the database")
+    subprocess.run([sys.executable, '-m', 'flask', '--app', server.cfg.wsgi_app or 'app:app', 'setup-db'],
+                   env=env, check=True)
+
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def post_worker_init(worker):
+    handle_exit = worker.handle_exit
+
+    def close_streams_and_exit(sig, frame):
+        broadcaster = worker.wsgi.extensions.get('event_broadcaster')
+        if broadcaster is not None:
+            broadcaster.close()
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, close_streams_and_exit)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,8 +1,10 @@
+import argparse
+import itertools
 import os
 import sqlite3
-from datetime import datetime, timedelta
-import random
-import math
+import time
+from datetime import datetime
+import numpy as np
 import pytz
 import logging
 
@@ -14,19 +16,25 @@ LITERS_PER_CM = 16  # Liters per cm of height
 USER_LOGIN = 'Ashiboy04'
 INITIAL_DATE = datetime(2025, 1, 25, 5, 29, 43, tzinfo=pytz.UTC)  # Specified UTC time
 DATABASE_PATH = 'data/water_levels.db'
+DEVICE_ID = 'tank-{}'  # Sample tanks are tank-1 .. tank-N; tank-1 is the app's default device
+IST_OFFSET_SECONDS = 5 * 3600 + 30 * 60
+
+# Usage model for the sample data, in fractions of the tank per hour
+BASE_DRAW = 0.01   # all day
+PEAK_DRAW = 0.15   # extra at the morning (07:00 IST) and evening (19:30 IST) peaks
+PUMP_RATE = 0.6    # while the pump runs
+PUMP_ON_LEVEL = 0.2
+PUMP_OFF_LEVEL = 0.95
+SENSOR_NOISE = 0.3  # cm, standard deviation of the ultrasonic reading
+CHUNK_ROWS = 100000  # readings generated and inserted per executemany
+COMMIT_ROWS = 5000000  # readings per transaction
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
 logger = logging.getLogger(__name__)
 
-def create_data_directory():
+def create_data_directory(path='data'):
     """Create data directory if it doesn't exist"""
     try:
-        os.makedirs('data', exist_ok=True)
+        os.makedirs(path, exist_ok=True)
         logger.info("Data directory checked/created successfully")
     except Exception as e:
         logger.error(f"Error creating data directory: {e}")
@@ -37,13 +45,19 @@ def create_tables(cursor):
     try:
         # Drop existing tables
         cursor.execute('DROP TABLE IF EXISTS water_levels')
+        cursor.execute('DROP TABLE IF EXISTS devices')
         cursor.execute('DROP TABLE IF EXISTS settings')
+        cursor.execute('DROP TABLE IF EXISTS usage_rollups')  # Recreated by the app, rebuild with `flask backfill-rollups`
+        cursor.execute('DROP TABLE IF EXISTS reading_aggregates')  # Recreated by the app
+        cursor.execute('DROP TABLE IF EXISTS events')  # Recreated by the app, rebuild with `flask backfill-events`
+        cursor.execute('DROP TABLE IF EXISTS event_detector_state')  # Recreated by the app
 
         # Create water_levels table
         cursor.execute('''
         CREATE TABLE water_levels (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME NOT NULL,
+            device_id VARCHAR(50) NOT NULL DEFAULT 'tank-1',
+            timestamp INTEGER NOT NULL,
             distance FLOAT NOT NULL,
             water_level FLOAT NOT NULL,
             water_volume FLOAT NOT NULL,
@@ -51,6 +65,18 @@ def create_tables(cursor):
         )
         ''')
 
+        # Create devices table
+        cursor.execute('''
+        CREATE TABLE devices (
+            id VARCHAR(50) PRIMARY KEY,
+            name VARCHAR(100),
+            min_distance FLOAT NOT NULL,
+            max_distance FLOAT NOT NULL,
+            liters_per_cm FLOAT NOT NULL,
+            created_at DATETIME
+        )
+        ''')
+
         # Create settings table
         cursor.execute('''
         CREATE TABLE settings (
@@ -69,6 +95,21 @@ def create_tables(cursor):
         logger.error(f"Error creating tables: {e}")
         raise
 
+def create_indexes(cursor):
+    """Create the reading indexes, after a bulk load so they are built in one pass"""
+    try:
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_device_timestamp ON water_levels (device_id, timestamp, water_level, id)'
+        )
+        logger.info("Indexes created successfully")
+    except Exception as e:
+        logger.error(f"Error creating indexes: {e}")
+        raise
+
+def drop_indexes(cursor):
+    """Drop the reading indexes before appending a bulk load"""
+    cursor.execute('DROP INDEX IF EXISTS idx_device_timestamp')
+
 def insert_default_settings(cursor):
     """Insert default settings for the user"""
     try:
@@ -88,66 +129,213 @@ def insert_default_settings(cursor):
         logger.error(f"Error inserting default settings: {e}")
         raise
 
-def generate_sample_data(cursor):
-    """Generate sample water level data with very random values"""
+def insert_devices(cursor, device_ids):
+    """Register the sample tanks, all with the default geometry"""
     try:
-        start_date = INITIAL_DATE - timedelta(days=150)  # 5 months of data
-        current_time = start_date
-        end_time = INITIAL_DATE
-
-        data_points = []
-        usable_height = MAX_DISTANCE - MIN_DISTANCE
-        
-        while current_time <= end_time:
-            # Generate very random water level data
-            distance = random.uniform(MIN_DISTANCE, MAX_DISTANCE)
-            
-            # Calculate water level and volume correctly
-            water_height = MAX_DISTANCE - distance
-            water_level = ((water_height - MIN_DISTANCE) / usable_height) * 100
-            water_volume = water_height * LITERS_PER_CM
-
-            data_points.append((
-                current_time.strftime('%Y-%m-%d %H:%M:%S'),
-                round(distance, 2),
-                round(max(0, min(100, water_level)), 2),
-                round(max(0, water_volume), 2),
-                'valid'
-            ))
-            
-            current_time += timedelta(hours=1)
-
         cursor.executemany('''
-        INSERT INTO water_levels (timestamp, distance, water_level, water_volume, status)
-        VALUES (?, ?, ?, ?, ?)
-        ''', data_points)
+        INSERT OR IGNORE INTO devices (id, name, min_distance, max_distance, liters_per_cm, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(device_id, f'Tank {i}', MIN_DISTANCE, MAX_DISTANCE, LITERS_PER_CM,
+               INITIAL_DATE.strftime('%Y-%m-%d %H:%M:%S')) for i, device_id in enumerate(device_ids, 1)])
+        logger.info(f"Devices registered: {', '.join(device_ids)}")
+    except Exception as e:
+        logger.error(f"Error registering devices: {e}")
+        raise
 
-        logger.info(f"Generated {len(data_points)} sample data points with very random values")
+def draw_rate(local_hours):
+    """Household draw in fractions of the tank per hour at an IST hour of day (float or array)"""
+    morning = np.exp(-((local_hours - 7) ** 2) / 2)
+    evening = 0.8 * np.exp(-((local_hours - 19.5) ** 2) / 3)
+    return BASE_DRAW + PEAK_DRAW * (morning + evening)
+
+class TankModel:
+    """Fill level of one tank over time: household draw, and a pump that refills it.
+
+    The draw follows draw_rate(), scaled per tank and per day. The pump
+    starts at PUMP_ON_LEVEL and stops at PUMP_OFF_LEVEL. The level is
+    integrated one drain or refill segment at a time, with cumulative sums
+    up to the next pump switch. run() continues where the previous call
+    stopped, so a long series can be generated in chunks.
+    """
+
+    def __init__(self, rng, fill=None, noise=SENSOR_NOISE):
+        self.rng = rng
+        self.noise = noise
+        self.fill = rng.uniform(0.3, 0.9) if fill is None else fill
+        self.pumping = False
+        self.draw_scale = rng.uniform(0.6, 1.4)  # Households use different amounts
+        self.day = None
+        self.day_factor = 1.0
+        self.last_epoch = None
+
+    def _day_factors(self, days):
+        """One random factor per IST day, so some days use more water than others"""
+        unique_days, inverse = np.unique(days, return_inverse=True)
+        factors = np.empty(len(unique_days))
+        for i, day in enumerate(unique_days):
+            if day != self.day:
+                self.day, self.day_factor = day, self.rng.lognormal(0, 0.25)
+            factors[i] = self.day_factor
+        return factors[inverse]
+
+    def run(self, epochs):
+        """Fill fraction (0-1) at each of the increasing epoch seconds"""
+        local = epochs + IST_OFFSET_SECONDS
+        previous = epochs[0] if self.last_epoch is None else self.last_epoch
+        hours = np.diff(epochs, prepend=previous) / 3600
+        draw = draw_rate((local % 86400) / 3600) * self.draw_scale * self._day_factors(local // 86400) * hours
+        pump = PUMP_RATE * hours
+
+        fills = np.empty(len(epochs))
+        i = 0
+        while i < len(epochs):
+            # Grow the window until the pump switches inside it or the chunk ends
+            window = 4096
+            while True:
+                j = min(len(epochs), i + window)
+                if self.pumping:
+                    path = self.fill + np.cumsum(pump[i:j] - draw[i:j])
+                    switches = np.flatnonzero(path >= PUMP_OFF_LEVEL)
+                else:
+                    path = self.fill - np.cumsum(draw[i:j])
+                    switches = np.flatnonzero(path <= PUMP_ON_LEVEL)
+                if switches.size or j == len(epochs):
+                    break
+                window *= 4
+            stop = i + switches[0] + 1 if switches.size else j
+            fills[i:stop] = np.clip(path[:stop - i], 0, 1)
+            self.fill = fills[stop - 1]
+            if switches.size:
+                self.pumping = not self.pumping
+            i = stop
+
+        self.last_epoch = epochs[-1]
+        return fills
+
+    def readings(self, epochs):
+        """(distance, water_level, water_volume) arrays, calculated as /update does"""
+        distance = MAX_DISTANCE - self.run(epochs) * (MAX_DISTANCE - MIN_DISTANCE)
+        distance = np.clip(distance + self.rng.normal(0, self.noise, len(epochs)), MIN_DISTANCE, MAX_DISTANCE)
+        distance = np.round(distance, 2)
+        water_height = MAX_DISTANCE - distance
+        water_level = (water_height / (MAX_DISTANCE - MIN_DISTANCE)) * 100
+        water_volume = water_height * LITERS_PER_CM
+        return distance, np.round(np.clip(water_level, 0, 100), 2), np.round(np.clip(water_volume, 0, None), 2)
+
+def fill_from_level(water_level):
+    """Fill fraction for a stored water level, to continue the model from the last reading"""
+    return min(1.0, max(0.0, water_level / 100))
+
+def generate_sample_data(cursor, start_epoch, count, interval, seed=0, initial_fill=None, noise=SENSOR_NOISE,
+                         chunk_rows=CHUNK_ROWS, commit_rows=COMMIT_ROWS, device_ids=(DEVICE_ID.format(1),)):
+    """Insert `count` modelled readings per device, `interval` seconds apart from `start_epoch`.
+
+    Readings are generated and inserted `chunk_rows` at a time, split over
+    the devices so their ids interleave in time as live data would, and
+    committed every `commit_rows`, so memory use does not grow with `count`.
+    `initial_fill` maps device ids to the fill to continue from.
+    """
+    try:
+        initial_fill = initial_fill or {}
+        # The first tank keeps the plain seed, so one tank gives the same data as before
+        models = [
+            TankModel(np.random.default_rng(seed if i == 0 else [seed, i]), initial_fill.get(device_id), noise)
+            for i, device_id in enumerate(device_ids)
+        ]
+        per_chunk = max(1, chunk_rows // len(device_ids))
+        total = count * len(device_ids)
+        generated = 0
+        inserted = 0
+        uncommitted = 0
+        started = time.monotonic()
+        while generated < count:
+            rows = min(per_chunk, count - generated)
+            epochs = start_epoch + (generated + np.arange(rows, dtype=np.int64)) * interval
+            for device_id, model in zip(device_ids, models):
+                distance, water_level, water_volume = model.readings(epochs)
+                cursor.executemany('''
+                INSERT INTO water_levels (device_id, timestamp, distance, water_level, water_volume, status)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ''', zip(itertools.repeat(device_id), epochs.tolist(), distance.tolist(), water_level.tolist(),
+                         water_volume.tolist(), itertools.repeat('valid')))
+            generated += rows
+            inserted += rows * len(device_ids)
+            uncommitted += rows * len(device_ids)
+            if uncommitted >= commit_rows:
+                cursor.connection.commit()
+                uncommitted = 0
+                logger.info(f"{inserted}/{total} readings ({inserted / (time.monotonic() - started):.0f}/s)")
+
+        logger.info(f"Generated {inserted} sample readings for {len(device_ids)} tank(s) in {time.monotonic() - started:.1f}s")
     except Exception as e:
         logger.error(f"Error generating sample data: {e}")
         raise
 
-def init_db():
-    """Initialize the database with tables and sample data"""
+def init_db(days=150, interval=3600, end_time=INITIAL_DATE, seed=0, append=False, database_path=DATABASE_PATH,
+            noise=SENSOR_NOISE, tanks=1):
+    """Initialize the database with tables and sample data.
+
+    Generates `days` of readings `interval` seconds apart for each of
+    `tanks` tanks, ending at `end_time`. With `append`, the existing data is
+    kept and the new readings continue from the last stored one.
+    """
     try:
         # Create data directory
-        create_data_directory()
+        create_data_directory(os.path.dirname(database_path) or '.')
 
         # Connect to SQLite database
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = sqlite3.connect(database_path)
         cursor = conn.cursor()
 
         # Enable foreign keys
         cursor.execute('PRAGMA foreign_keys = ON')
+        # Lets the app's retention hand freed pages back to the OS, like the databases it creates
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # Bulk load: no fsync per transaction and a large page cache
+        cursor.execute('PRAGMA synchronous = OFF')
+        cursor.execute('PRAGMA cache_size = -262144')
+
+        count = int(days * 86400 // interval)
+        start_epoch = int(end_time.timestamp()) - (count - 1) * interval
+        device_ids = [DEVICE_ID.format(i) for i in range(1, tanks + 1)]
+        initial_fill = {}
+
+        if append:
+            cursor.execute('PRAGMA table_info(water_levels)')
+            if 'device_id' not in [column[1] for column in cursor.fetchall()]:
+                raise RuntimeError('The database predates devices, start the app once to migrate it before appending')
+            cursor.execute('SELECT COUNT(*) FROM water_levels')
+            existing = cursor.fetchone()[0]
+            last_epochs = []
+            for device_id in device_ids:
+                cursor.execute(
+                    'SELECT timestamp, water_level FROM water_levels WHERE device_id = ? ORDER BY timestamp DESC LIMIT 1',
+                    (device_id,)
+                )
+                last = cursor.fetchone()
+                if last:
+                    last_epochs.append(last[0])
+                    initial_fill[device_id] = fill_from_level(last[1])
+            # Continue every tank after the newest reading of any of them
+            if last_epochs:
+                start_epoch = max(last_epochs) + interval
+            # Rebuilding is only cheaper than updating the index when the load is large
+            if count * tanks > existing:
+                drop_indexes(cursor)
+            logger.info(f"Appending {count * tanks} readings to {existing} existing ones")
+        else:
+            # Create tables
+            create_tables(cursor)
+            # An existing file only switches to incremental auto_vacuum on VACUUM, cheap while it is empty
+            cursor.execute('VACUUM')
 
-        # Create tables
-        create_tables(cursor)
-
-        # Insert default settings
-        insert_default_settings(cursor)
+            # Insert default settings
+            insert_default_settings(cursor)
+        insert_devices(cursor, device_ids)
 
-        # Generate sample data
-        generate_sample_data(cursor)
+        # Generate sample data, then index it
+        generate_sample_data(cursor, start_epoch, count, interval, seed, initial_fill, noise, device_ids=device_ids)
+        create_indexes(cursor)
 
         # Commit changes
         conn.commit()
@@ -158,8 +346,12 @@ def init_db():
         data_count = cursor.fetchone()[0]
         cursor.execute('SELECT COUNT(*) FROM settings')
         settings_count = cursor.fetchone()[0]
+        cursor.execute('SELECT COUNT(*) FROM devices')
+        device_count = cursor.fetchone()[0]
 
-        logger.info(f"Verification: {data_count} water level readings, {settings_count} settings records")
+        logger.info(
+            f"Verification: {data_count} water level readings, {device_count} devices, {settings_count} settings records"
+        )
 
         return True
 
@@ -174,10 +366,10 @@ def init_db():
             conn.close()
             logger.info("Database connection closed")
 
-def verify_database():
+def verify_database(database_path=DATABASE_PATH):
     """Verify database integrity and data"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = sqlite3.connect(database_path)
         cursor = conn.cursor()
 
         # Check tables exist
@@ -186,9 +378,12 @@ def verify_database():
         logger.info(f"Found tables: {[table[0] for table in tables]}")
 
         # Check water_levels data
-        cursor.execute('SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM water_levels')
-        count, min_date, max_date = cursor.fetchone()
-        logger.info(f"Water levels: {count} records from {min_date} to {max_date}")
+        cursor.execute(
+            "SELECT device_id, COUNT(*), datetime(MIN(timestamp), 'unixepoch'), datetime(MAX(timestamp), 'unixepoch') "
+            "FROM water_levels GROUP BY device_id"
+        )
+        for device_id, count, min_date, max_date in cursor.fetchall():
+            logger.info(f"Water levels of {device_id}: {count} records from {min_date} to {max_date}")
 
         # Check settings
         cursor.execute('SELECT * FROM settings')
@@ -205,15 +400,54 @@ def verify_database():
         if 'conn' in locals():
             conn.close()
 
+def parse_end_time(value):
+    """'now', 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' (UTC)"""
+    if value == 'now':
+        return datetime.now(pytz.UTC).replace(microsecond=0)
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return pytz.UTC.localize(datetime.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"invalid end time: {value}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Create the database and fill it with modelled sample readings')
+    parser.add_argument('--days', type=float, default=150, help='days of readings to generate (default 150)')
+    parser.add_argument('--interval', type=int, default=3600, help='seconds between readings (default 3600)')
+    parser.add_argument('--tanks', type=int, default=1, help='number of tanks to simulate (default 1)')
+    parser.add_argument('--end', type=parse_end_time, default=INITIAL_DATE,
+                        help="UTC time of the last reading, 'YYYY-MM-DD[ HH:MM:SS]' or 'now' (default the initial date)")
+    parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed gives the same data (default 0)')
+    parser.add_argument('--noise', type=float, default=SENSOR_NOISE,
+                        help=f'sensor noise in cm (default {SENSOR_NOISE}); every drop counts as usage, so lower it for sub-minute intervals')
+    parser.add_argument('--append', action='store_true', help='keep the existing data and continue after its last reading')
+    parser.add_argument('--db', default=DATABASE_PATH, help=f'database file (default {DATABASE_PATH})')
+    args = parser.parse_args()
+    if args.interval <= 0 or args.days <= 0:
+        parser.error('--days and --interval must be positive')
+    if args.tanks < 1:
+        parser.error('--tanks must be at least 1')
+    return args
+
 if __name__ == '__main__':
+    # Configure logging here, not on import: benchmark.py's worker needs app.py's handlers
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    args = parse_args()
     logger.info("Starting database initialization...")
-    logger.info(f"Initial date: {INITIAL_DATE}")
+    logger.info(f"End date: {args.end}")
     logger.info(f"User login: {USER_LOGIN}")
     
-    if init_db():
-        if verify_database():
+    if init_db(args.days, args.interval, args.end, args.seed, args.append, args.db, args.noise, args.tanks):
+        if verify_database(args.db):
             logger.info("Database initialized and verified successfully!")
             print("Database initialized and verified successfully!")
+            print("Run `flask backfill-rollups` to build the usage statistics for the sample data,")
+            print("and `flask backfill-events` to detect its usage and refill events.")
         else:
             logger.error("Database verification failed!")
             print("Database verification failed!")
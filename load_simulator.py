@@ -0,0 +1,417 @@
+"""Device-fleet load simulator.
+
+Simulates N tank sensors and M dashboards against one server, and reports
+throughput, p50/p99 latency per endpoint and error and lock rates.
+
+Each device does the following:
+- polls /api/config/current with If-None-Match, like the firmware.
+- posts a reading to /update every `--normal-interval` seconds, or every
+  `--fast-interval` seconds while the config has fast_data on.
+- checks /api/firmware about once per `--firmware-interval` seconds.
+The readings follow a tank model: household draw with morning and evening
+peaks, and a pump that refills the tank from 20% to 95%. With `--tanks N`
+the sensors report for tank-1 .. tank-N, registered before the run, and each
+dashboard watches one of them.
+
+Dashboards poll like dashboard.js: /api/latest, the incremental /api/data
+chart and the weekly and daily stats every 5 seconds, with the same ETags.
+With `--dashboard-stream` they hold /api/stream open instead, and poll only
+the weekly stats every minute.
+
+By default a gunicorn is started in `--workdir` (its database is
+`--workdir/data/water_levels.db`, so copy one there to load-test a large
+database). Pass `--url` to target a server that is already running.
+
+    python load_simulator.py --devices 500 --dashboards 20 --duration 120 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+
+import init_db
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DASHBOARD_UPDATE_INTERVAL = 5  # seconds, UPDATE_INTERVAL in dashboard.js
+DASHBOARD_SLOW_INTERVAL = 60  # seconds, SLOW_UPDATE_INTERVAL in dashboard.js
+DASHBOARD_CHART_POINTS = 1000  # MAX_CHART_POINTS in dashboard.js
+
+# Expected statuses per endpoint; anything else is an error
+EXPECTED_STATUS = {
+    'GET /api/config/current': {200, 304},
+    'POST /update': {200, 202},
+    'GET /api/firmware': {200, 206, 304, 404},  # 404 until firmware is uploaded
+    'GET /api/latest': {200},
+    'GET /api/data': {200, 304},
+    'GET /api/stats/weekly': {200, 304},
+    'GET /api/stats/daily': {200, 304},
+    'GET /api/stream': {200},
+}
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+
+class Stats:
+    """Latency samples and outcome counts per endpoint"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.errors = Counter()
+        self.locks = Counter()
+        self.stream_events = 0
+
+    def record(self, endpoint, seconds, status, body=b''):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][str(status)] += 1
+        if status not in EXPECTED_STATUS[endpoint]:
+            self.errors[endpoint] += 1
+            # 503 is load shedding (ingest queue or stream limit), a 500 naming the lock is SQLite contention
+            if status == 503 or (status == 500 and b'locked' in body):
+                self.locks[endpoint] += 1
+
+    def report(self, duration):
+        endpoints = {}
+        for endpoint, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            endpoints[endpoint] = {
+                'requests': len(samples),
+                'throughput': round(len(samples) / duration, 2),
+                'p50_ms': round(percentile(samples, 0.50) * 1000, 2),
+                'p99_ms': round(percentile(samples, 0.99) * 1000, 2),
+                'max_ms': round(samples[-1] * 1000, 2),
+                'mean_ms': round(statistics.fmean(samples) * 1000, 2),
+                'errors': self.errors[endpoint],
+                'locks': self.locks[endpoint],
+                'statuses': dict(self.statuses[endpoint]),
+            }
+        requests = sum(e['requests'] for e in endpoints.values())
+        return {
+            'duration': round(duration, 2),
+            'requests': requests,
+            'throughput': round(requests / duration, 2),
+            'error_rate': round(sum(self.errors.values()) / requests, 6) if requests else 0.0,
+            'lock_rate': round(sum(self.locks.values()) / requests, 6) if requests else 0.0,
+            'stream_events': self.stream_events,
+            'endpoints': endpoints,
+        }
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of sorted samples"""
+    return samples[min(len(samples) - 1, max(0, math.ceil(fraction * len(samples)) - 1))]
+
+
+async def call(session, stats, endpoint, method, url, **kwargs):
+    """Make one request and record it; returns (status, headers, body), or None on a connection error"""
+    started = time.perf_counter()
+    try:
+        async with session.request(method, url, **kwargs) as response:
+            body = await response.read()
+            stats.record(endpoint, time.perf_counter() - started, response.status, body)
+            return response.status, response.headers, body
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        stats.record(endpoint, time.perf_counter() - started, type(e).__name__)
+        return None
+
+
+class Tank:
+    """Water in one tank, advanced in simulated time with init_db's usage model"""
+
+    def __init__(self, rng, time_scale):
+        self.rng = rng
+        self.time_scale = time_scale
+        self.fill = rng.uniform(0.3, 0.9)
+        self.draw_scale = rng.uniform(0.6, 1.4)  # Households use different amounts
+        self.pumping = False
+        self.started = self.updated = time.time()
+
+    def distance(self):
+        """Advance to now and return a sensor reading in cm"""
+        now = time.time()
+        hours = (now - self.updated) * self.time_scale / 3600
+        simulated = self.started + (now - self.started) * self.time_scale
+        self.updated = now
+
+        local_hour = ((simulated + init_db.IST_OFFSET_SECONDS) % 86400) / 3600
+        self.fill -= init_db.draw_rate(local_hour) * self.draw_scale * hours
+        if self.pumping:
+            self.fill += init_db.PUMP_RATE * hours
+        self.fill = min(1.0, max(0.0, self.fill))
+        if self.fill <= init_db.PUMP_ON_LEVEL:
+            self.pumping = True
+        elif self.fill >= init_db.PUMP_OFF_LEVEL:
+            self.pumping = False
+
+        distance = init_db.MAX_DISTANCE - self.fill * (init_db.MAX_DISTANCE - init_db.MIN_DISTANCE)
+        distance += self.rng.gauss(0, init_db.SENSOR_NOISE)
+        return round(min(init_db.MAX_DISTANCE, max(init_db.MIN_DISTANCE, distance)), 2)
+
+
+async def run_device(index, session, base_url, stats, args):
+    rng = random.Random(f"{args.seed}-device-{index}")
+    tank = Tank(rng, args.time_scale)
+    loop = asyncio.get_running_loop()
+    fast_data = False
+    config_etag = firmware_etag = None
+
+    # Spread the fleet over the intervals instead of starting in lockstep
+    now = loop.time()
+    next_config = now + rng.uniform(0, args.config_interval)
+    next_update = now + rng.uniform(0, args.normal_interval)
+    next_firmware = now + rng.expovariate(1 / args.firmware_interval)
+
+    while True:
+        await asyncio.sleep(max(0.0, min(next_config, next_update, next_firmware) - loop.time()))
+        now = loop.time()
+
+        if now >= next_config:
+            headers = {'If-None-Match': config_etag} if config_etag else {}
+            result = await call(session, stats, 'GET /api/config/current', 'GET', f"{base_url}/api/config/current", headers=headers)
+            if result and result[0] == 200:
+                config_etag = result[1].get('ETag')
+                fast_data = result[2].split(b'\n', 1)[0].strip() == b'1'
+            next_config = now + args.config_interval
+
+        if now >= next_update:
+            await call(session, stats, 'POST /update', 'POST', f"{base_url}/update",
+                       json={'device_id': tank_id(index, args), 'distance': tank.distance()})
+            next_update = now + (args.fast_interval if fast_data else args.normal_interval)
+
+        if now >= next_firmware:
+            headers = {'If-None-Match': firmware_etag} if firmware_etag else {}
+            result = await call(session, stats, 'GET /api/firmware', 'GET', f"{base_url}/api/firmware", headers=headers)
+            if result and result[0] == 200:
+                firmware_etag = result[1].get('ETag')
+            next_firmware = now + rng.expovariate(1 / args.firmware_interval)
+
+
+async def follow_stream(session, base_url, stats, state, device_id):
+    """Hold /api/stream open like EventSource, counting the events received"""
+    while True:
+        started = time.perf_counter()
+        try:
+            async with session.get(f"{base_url}/api/stream?device={device_id}", timeout=aiohttp.ClientTimeout(total=None)) as response:
+                stats.record('GET /api/stream', time.perf_counter() - started, response.status)
+                if response.status != 200:
+                    await asyncio.sleep(int(response.headers.get('Retry-After', '30')))
+                    continue
+                state['streaming'] = True
+                async for line in response.content:
+                    if line.startswith(b'event:'):
+                        stats.stream_events += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            stats.record('GET /api/stream', time.perf_counter() - started, type(e).__name__)
+        state['streaming'] = False
+        await asyncio.sleep(3)  # The retry interval the server asks for
+
+
+async def run_dashboard(index, session, base_url, stats, args):
+    rng = random.Random(f"{args.seed}-dashboard-{index}")
+    device_id = tank_id(index, args)
+    etags = {}
+    cursor = None
+    state = {'streaming': False}
+
+    async def fetch_if_changed(endpoint, url):
+        headers = {'If-None-Match': etags[url]} if url in etags else {}
+        result = await call(session, stats, endpoint, 'GET', url, headers=headers)
+        if not result or result[0] != 200:
+            return None
+        if result[1].get('ETag'):
+            etags[url] = result[1]['ETag']
+        return json.loads(result[2])
+
+    async def refresh_chart():
+        nonlocal cursor
+        url = f"{base_url}/api/data?device={device_id}&hours=24&max_points={DASHBOARD_CHART_POINTS}"
+        if cursor is None:
+            result = await call(session, stats, 'GET /api/data', 'GET', f"{url}&format=binary")
+            if result and result[0] == 200 and result[1].get('X-Next-Since-Id'):
+                cursor = int(result[1]['X-Next-Since-Id'])
+            return
+        data = await fetch_if_changed('GET /api/data', f"{url}&format=columnar&since_id={cursor}")
+        if data and data.get('next_since_id') is not None:
+            cursor = data['next_since_id']
+
+    await asyncio.sleep(rng.uniform(0, DASHBOARD_UPDATE_INTERVAL))
+    stream = asyncio.create_task(follow_stream(session, base_url, stats, state, device_id)) if args.dashboard_stream else None
+    try:
+        while True:
+            if state['streaming']:
+                await fetch_if_changed('GET /api/stats/weekly', f"{base_url}/api/stats/weekly?device={device_id}")
+                await asyncio.sleep(DASHBOARD_SLOW_INTERVAL)
+                continue
+            # Weather comes from OpenWeather directly in the browser, not from this server
+            await asyncio.gather(
+                call(session, stats, 'GET /api/latest', 'GET', f"{base_url}/api/latest?device={device_id}"),
+                refresh_chart(),
+                fetch_if_changed('GET /api/stats/weekly', f"{base_url}/api/stats/weekly?device={device_id}")
+            )
+            await fetch_if_changed('GET /api/stats/daily', f"{base_url}/api/stats/daily?device={device_id}")
+            await asyncio.sleep(DASHBOARD_UPDATE_INTERVAL)
+    finally:
+        if stream:
+            stream.cancel()
+
+
+def tank_id(index, args):
+    """Tank reported by sensor / watched by dashboard `index`"""
+    return init_db.DEVICE_ID.format(index % args.tanks + 1)
+
+
+async def register_tanks(session, base_url, count):
+    for i in range(1, count + 1):
+        async with session.post(f"{base_url}/api/devices", json={'device_id': init_db.DEVICE_ID.format(i)}) as response:
+            response.raise_for_status()
+    logger.info(f"Registered {count} tank(s)")
+
+
+async def set_fast_data(session, base_url, enabled):
+    async with session.get(f"{base_url}/api/config") as response:
+        config = await response.json()
+    config['fast_data'] = enabled
+    config['wifi_ssid'] = config.get('wifi_ssid') or 'loadtest'  # Required by the handler, empty in a fresh work directory
+    async with session.post(f"{base_url}/api/config", json=config) as response:
+        response.raise_for_status()
+    logger.info(f"fast_data set to {enabled}")
+
+
+async def wait_until_ready(session, base_url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{base_url}/api/health") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"Server at {base_url} did not become healthy within {timeout}s")
+
+
+async def simulate(base_url, args):
+    stats = Stats()
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        await wait_until_ready(session, base_url, args.startup_timeout)
+        await register_tanks(session, base_url, args.tanks)
+        if args.fast_data != 'keep':
+            await set_fast_data(session, base_url, args.fast_data == 'on')
+
+        tasks = [asyncio.create_task(run_device(i, session, base_url, stats, args)) for i in range(args.devices)]
+        tasks += [asyncio.create_task(run_dashboard(i, session, base_url, stats, args)) for i in range(args.dashboards)]
+        logger.info(f"Running {args.devices} devices and {args.dashboards} dashboards for {args.duration}s")
+
+        started = time.monotonic()
+        await asyncio.sleep(args.duration)
+        duration = time.monotonic() - started
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return stats.report(duration)
+
+
+def start_server(args):
+    """Start gunicorn in the work directory and return the process"""
+    os.makedirs(args.workdir, exist_ok=True)
+    log = open(os.path.join(args.workdir, 'gunicorn.log'), 'ab')
+    command = [
+        sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_DIR, 'gunicorn.conf.py'),
+        '--pythonpath', REPO_DIR, '--workers', str(args.workers), '--threads', str(args.threads),
+        '--bind', f"127.0.0.1:{args.port}", 'app:app'
+    ]
+    logger.info(f"Starting gunicorn in {args.workdir} with {args.workers} workers x {args.threads} threads")
+    return subprocess.Popen(command, cwd=args.workdir, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_server(server, timeout=30):
+    """Stop gunicorn, killing it if it hasn't shut down within `timeout` seconds"""
+    server.terminate()
+    try:
+        server.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.warning(f"gunicorn did not stop within {timeout}s, killing it")
+        server.kill()
+        server.wait()
+
+
+def print_report(report):
+    print(f"{'endpoint':<26} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7} {'locks':>6}")
+    for endpoint, e in report['endpoints'].items():
+        print(
+            f"{endpoint:<26} {e['requests']:>9} {e['throughput']:>8.1f} {e['p50_ms']:>8.1f} {e['p99_ms']:>8.1f} "
+            f"{e['max_ms']:>8.1f} {e['errors']:>7} {e['locks']:>6}"
+        )
+    print(
+        f"{'total':<26} {report['requests']:>9} {report['throughput']:>8.1f}  "
+        f"error rate {report['error_rate']:.2%}, lock rate {report['lock_rate']:.2%}, "
+        f"{report['stream_events']} stream events"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a fleet of tank sensors and dashboards against the server')
+    parser.add_argument('--devices', type=int, default=100, help='simulated tank sensors (default 100)')
+    parser.add_argument('--tanks', type=int, default=1, help='tanks the sensors are spread over (default 1)')
+    parser.add_argument('--dashboards', type=int, default=5, help='simulated open dashboards (default 5)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of load (default 60)')
+    parser.add_argument('--normal-interval', type=float, default=60, help='seconds between readings (default 60)')
+    parser.add_argument('--fast-interval', type=float, default=5, help='seconds between readings with fast_data on (default 5)')
+    parser.add_argument('--config-interval', type=float, default=30, help='seconds between config polls (default 30)')
+    parser.add_argument('--firmware-interval', type=float, default=600, help='mean seconds between firmware checks (default 600)')
+    parser.add_argument('--fast-data', choices=('keep', 'on', 'off'), default='keep', help='set fast_data in the config before the run')
+    parser.add_argument('--dashboard-stream', action='store_true', help='dashboards use /api/stream instead of polling')
+    parser.add_argument('--time-scale', type=float, default=60, help='simulated seconds per real second for the tank model (default 60)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed (default 1)')
+    parser.add_argument('--connections', type=int, default=200, help='client connection pool size (default 200)')
+    parser.add_argument('--request-timeout', type=float, default=30, help='seconds before a request counts as failed (default 30)')
+    parser.add_argument('--url', help='target this running server instead of starting gunicorn')
+    parser.add_argument('--workdir', default='loadtest_data', help='where gunicorn runs and keeps data/ (default loadtest_data)')
+    parser.add_argument('--port', type=int, default=8099, help='port for the started gunicorn (default 8099)')
+    parser.add_argument('--workers', type=int, default=3, help='gunicorn workers (default 3)')
+    parser.add_argument('--threads', type=int, default=16, help='threads per gunicorn worker (default 16)')
+    parser.add_argument('--startup-timeout', type=float, default=30, help='seconds to wait for /health (default 30)')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args()
+    if args.tanks < 1:
+        parser.error('--tanks must be at least 1')
+
+    server = None
+    base_url = args.url.rstrip('/') if args.url else f"http://127.0.0.1:{args.port}"
+    if not args.url:
+        args.workdir = os.path.abspath(args.workdir)
+        server = start_server(args)
+    try:
+        report = asyncio.run(simulate(base_url, args))
+        # Report before stopping the server, so a slow shutdown can't lose it
+        report['config'] = {k: v for k, v in vars(args).items() if k not in ('output',)}
+        print_report(report)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Report written to {args.output}")
+    finally:
+        if server:
+            stop_server(server)
+    return 1 if report['error_rate'] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""Prometheus metrics served on /metrics.
+
+When PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py does this) every
+worker records its samples in memory-mapped files in that directory and
+render() adds them up. The scrape then gives the same totals whichever
+worker answers it. Without it, e.g. under `python app.py`, the default
+single-process registry is used.
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+
+REQUEST_LATENCY = Histogram(
+    'water_monitor_http_request_duration_seconds',
+    'Time until the response is handed to the server, per route',
+    ['endpoint', 'method', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    'water_monitor_http_requests_in_progress',
+    'Requests being handled, per route',
+    ['endpoint'],
+    multiprocess_mode='livesum'
+)
+RESPONSE_SIZE = Histogram(
+    'water_monitor_http_response_size_bytes',
+    'Response body size, per route (streamed responses are not counted)',
+    ['endpoint'],
+    buckets=SIZE_BUCKETS
+)
+INGEST_READINGS = Counter(
+    'water_monitor_ingest_readings_total',
+    'Readings received, by route and by whether they passed the distance check',
+    ['source', 'result']
+)
+DB_QUERY_LATENCY = Histogram(
+    'water_monitor_db_query_duration_seconds',
+    'SQL statement execution time, by statement type',
+    ['statement'],
+    buckets=QUERY_BUCKETS
+)
+WEATHER_UPSTREAM_LATENCY = Histogram(
+    'water_monitor_weather_upstream_duration_seconds',
+    'OpenWeather call duration',
+    buckets=LATENCY_BUCKETS
+)
+WEATHER_CACHE_EVENTS = Counter(
+    'water_monitor_weather_cache_events_total',
+    'Weather cache lookups (hits, stale_hits, misses) and upstream calls/errors',
+    ['event']
+)
+
+STATEMENT_TYPES = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'PRAGMA'}
+
+
+def statement_type(statement):
+    keyword = statement.lstrip().split(None, 1)[0].upper()
+    return keyword if keyword in STATEMENT_TYPES else 'OTHER'
+
+
+def render():
+    """Return (body, content type) for a scrape"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
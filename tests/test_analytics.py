@@ -0,0 +1,162 @@
+"""Parity tests: analytics.usage_by_period against the per-reading rollups.
+
+/update folds every reading into its hour and day rollups with
+apply_reading_to_rollups, and `flask backfill-rollups` rebuilds the same
+rows with analytics.usage_by_period. Both are run on random readings with
+irregular gaps (some across IST midnight), usage, refills and rises below
+the refill threshold, and must agree.
+
+    python -m pytest tests
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import pytz
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import analytics  # noqa: E402
+
+IST = pytz.timezone('Asia/Kolkata')
+UNIX_EPOCH = datetime(1970, 1, 1)
+FLOAT_FIELDS = ('level_sum', 'min_level', 'max_level', 'consumption', 'last_level')
+EXACT_FIELDS = ('reading_count', 'last_reading_at', 'last_refill_at')
+
+
+@pytest.fixture(scope='module')
+def water_app(tmp_path_factory):
+    """app.py, imported from an empty directory so its database and logs go there"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    os.environ['RETENTION_INTERVAL'] = '0'
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+    return app
+
+
+def random_readings(seed, count=5000):
+    """Epoch seconds and levels: mostly minute readings, with gaps of up to 9 hours"""
+    rng = np.random.default_rng(seed)
+    gaps = rng.choice([60, 300, 900, 3 * 3600, 9 * 3600], size=count, p=[.6, .2, .12, .05, .03])
+    epochs = 1700000000 + np.cumsum(gaps)
+    levels = []
+    level = 80.0
+    for draw in rng.random(count):
+        if draw < 0.03:
+            level = min(100.0, level + rng.uniform(5, 40))  # Refill
+        elif draw < 0.25:
+            level = min(100.0, level + rng.uniform(0, 0.99))  # Noise, below the refill threshold
+        else:
+            level = max(0.0, level - rng.uniform(0, 2))  # Usage
+        levels.append(round(level, 2))
+    return epochs, np.array(levels)
+
+
+def sequential_rollups(water_app, device, epochs, levels):
+    """Rollups built one reading at a time, as /update does"""
+    rollups = {}
+
+    def get_rollup(device_id, period, bucket_start):
+        if (period, bucket_start) not in rollups:
+            rollups[(period, bucket_start)] = SimpleNamespace(
+                reading_count=0, level_sum=0, min_level=None, max_level=None, consumption=0,
+                last_level=None, last_reading_at=None, last_refill_at=None
+            )
+        return rollups[(period, bucket_start)]
+
+    for epoch, level in zip(epochs.tolist(), levels.tolist()):
+        water_app.apply_reading_to_rollups(device, UNIX_EPOCH + timedelta(seconds=epoch), level, get_rollup)
+    return {key: vars(rollup) for key, rollup in rollups.items()}
+
+
+def vectorized_rollups(device, epochs, levels, refill_threshold):
+    """The same rollups from analytics.usage_by_period"""
+    summaries = analytics.usage_by_period(
+        analytics.from_epoch_seconds(epochs), levels, IST, device.liters_per_cm, refill_threshold
+    )
+    rollups = {}
+    for period, summary in summaries.items():
+        for i in range(len(summary['bucket'])):
+            last_refill_at = summary['last_refill_at'][i]
+            rollups[(period, summary['bucket_start'][i].astype(datetime))] = {
+                'reading_count': int(summary['reading_count'][i]),
+                'level_sum': float(summary['level_sum'][i]),
+                'min_level': float(summary['min_level'][i]),
+                'max_level': float(summary['max_level'][i]),
+                'consumption': float(summary['consumption'][i]),
+                'last_level': float(summary['last_level'][i]),
+                'last_reading_at': summary['last_reading_at'][i].astype(datetime),
+                'last_refill_at': None if np.isnat(last_refill_at) else last_refill_at.astype(datetime),
+            }
+    return rollups
+
+
+def assert_same_rollups(actual, expected):
+    assert sorted(actual) == sorted(expected)
+    for key, rollup in expected.items():
+        for field in EXACT_FIELDS:
+            assert actual[key][field] == rollup[field], (key, field)
+        for field in FLOAT_FIELDS:
+            assert actual[key][field] == pytest.approx(rollup[field], rel=1e-9, abs=1e-9), (key, field)
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_usage_by_period_matches_per_reading_rollups(water_app, seed):
+    device = SimpleNamespace(id='tank-test', liters_per_cm=7.5)
+    epochs, levels = random_readings(seed)
+    expected = sequential_rollups(water_app, device, epochs, levels)
+    actual = vectorized_rollups(device, epochs, levels, water_app.REFILL_THRESHOLD)
+
+    assert any(rollup['last_refill_at'] for rollup in expected.values())
+    assert_same_rollups(actual, expected)
+
+
+def test_backfill_matches_incremental_rollups(water_app):
+    device_id = 'tank-backfill'
+    epochs, levels = random_readings(4, count=3000)
+    with water_app.app.app_context():
+        water_app.db.session.add(water_app.Device(
+            id=device_id, min_distance=20, max_distance=150, liters_per_cm=7.5
+        ))
+        water_app.db.session.commit()
+        device = water_app.get_device(device_id)
+
+        rows = [
+            {
+                'device_id': device_id,
+                'timestamp': UNIX_EPOCH + timedelta(seconds=epoch),
+                'distance': 0.0,
+                'water_level': level,
+                'water_volume': 0.0,
+                'status': 'valid'
+            }
+            for epoch, level in zip(epochs.tolist(), levels.tolist())
+        ]
+        for start in range(0, len(rows), 700):
+            water_app.store_readings(rows[start:start + 700])
+
+        def stored_rollups():
+            query = water_app.UsageRollup.query.filter_by(device_id=device_id)
+            return {
+                (rollup.period, rollup.bucket_start): {field: getattr(rollup, field) for field in FLOAT_FIELDS + EXACT_FIELDS}
+                for rollup in query
+            }
+
+        incremental = stored_rollups()
+        assert water_app.backfill_device_rollups(device) == (len(rows), len(incremental))
+        assert_same_rollups(stored_rollups(), incremental)
+
+
+def test_usage_by_period_without_readings():
+    summaries = analytics.usage_by_period(
+        analytics.from_epoch_seconds([]), np.array([], dtype=float), IST, 7.5
+    )
+    assert set(summaries) == {'hour', 'day'}
+    assert all(len(summary['bucket_start']) == 0 for summary in summaries.values())
@@ -0,0 +1,186 @@
+"""Shared TTL cache for the OpenWeather current-weather API.
+
+All dashboards ask for the same location, so one upstream call per TTL is
+enough. Fresh data is served from memory; once it is older than `ttl` the
+stale copy is still served while a background thread refreshes it
+(stale-while-revalidate). Only when there is nothing usable (no data, or
+older than `max_stale`) does a request wait for the upstream call, and
+concurrent waiters share that one call.
+
+When `cache_file` is given the payload is also written there, and refreshes
+are serialized with an flock on `<cache_file>.lock`, so the gunicorn workers
+share a single upstream call per TTL as well.
+
+`on_count(key)` is called for every increment of `stats`, and
+`on_fetch(seconds)` after every upstream call, for metrics.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class WeatherCache:
+    def __init__(self, url, params, ttl=600, max_stale=3600, timeout=5, cache_file=None, session=None,
+                 on_count=None, on_fetch=None):
+        self.url = url
+        self.params = params
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.timeout = timeout
+        self.cache_file = cache_file
+        self.session = session or self._make_session()
+        self.on_count = on_count
+        self.on_fetch = on_fetch
+
+        self.data = None
+        self.fetched_at = 0.0
+        self.file_mtime = 0.0
+        self.refreshing = False
+        self.fetch_lock = threading.Lock()  # One upstream call at a time per process
+        self.state_lock = threading.Lock()
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'upstream_calls': 0, 'upstream_errors': 0}
+
+        self._load_file()
+
+    @staticmethod
+    def _make_session():
+        """Keep-alive session so refreshes reuse the upstream TLS connection"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def get(self):
+        """Return the upstream JSON payload, raising requests.RequestException if none is available"""
+        self._load_file()
+        age = self.age()
+
+        if self.data is not None and age < self.ttl:
+            self._count('hits')
+            return self.data
+
+        if self.data is not None and age < self.max_stale:
+            self._count('stale_hits')
+            self._refresh_in_background()
+            return self.data
+
+        self._count('misses')
+        with self.fetch_lock:
+            # Another request may have fetched while we waited for the lock
+            if self.data is None or self.age() >= self.ttl:
+                self._fetch_shared(blocking=True)
+        if self.data is None:
+            raise requests.RequestException('No weather data available')
+        return self.data
+
+    def _count(self, key):
+        with self.state_lock:
+            self.stats[key] += 1
+        if self.on_count:
+            self.on_count(key)
+
+    def _refresh_in_background(self):
+        with self.state_lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._background_refresh, name='weather-refresh', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self.fetch_lock:
+                self._fetch_shared(blocking=False)
+        except Exception as e:
+            logger.warning(f"Background weather refresh failed: {e}")
+        finally:
+            with self.state_lock:
+                self.refreshing = False
+
+    def _fetch_shared(self, blocking):
+        """Fetch upstream unless another worker holds the lock or has just refreshed"""
+        with self._file_lock(blocking) as acquired:
+            if not acquired:
+                return
+            self._load_file()
+            if self.data is not None and self.age() < self.ttl:
+                return
+            self._fetch()
+
+    def _fetch(self):
+        self._count('upstream_calls')
+        started = time.monotonic()
+        try:
+            response = self.session.get(self.url, params=self.params, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError):
+            self._count('upstream_errors')
+            raise
+        finally:
+            if self.on_fetch:
+                self.on_fetch(time.monotonic() - started)
+
+        self.data, self.fetched_at = data, time.time()
+        self._write_file()
+
+    @contextmanager
+    def _file_lock(self, blocking):
+        if not self.cache_file or fcntl is None:
+            yield True
+            return
+        with open(self.cache_file + '.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_file(self):
+        """Adopt a newer payload written by another worker (one stat() when unchanged)"""
+        if not self.cache_file:
+            return
+        try:
+            mtime = os.stat(self.cache_file).st_mtime
+            if mtime <= self.file_mtime:
+                return
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+            self.file_mtime = mtime
+            if cached['fetched_at'] > self.fetched_at:
+                self.data, self.fetched_at = cached['data'], cached['fetched_at']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable weather cache file: {e}")
+
+    def _write_file(self):
+        if not self.cache_file:
+            return
+        tmp_path = f"{self.cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'fetched_at': self.fetched_at, 'data': self.data}, f)
+            os.replace(tmp_path, self.cache_file)
+        except OSError as e:
+            logger.warning(f"Could not write weather cache file: {e}")